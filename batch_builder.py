@@ -0,0 +1,269 @@
+"""
+Builds the layers of several month folders in one run, e.g. to reprocess the
+archive (october2019, Apr2020, may2020, ...) after a fix.
+
+The static inputs every month uses are loaded once in the parent process: the
+counties layer (read and reprojected to NY State Plane), the Stations.csv table
+and StationEntrances.csv. A month whose folder holds an archived
+StationEntrances.csv is built with that copy instead, which is left as is. The
+months are built in parallel, one month per worker process, each with its own
+build manifest, so months whose inputs haven't changed are skipped. Layers are
+named after the month of their folder rather than the current month.
+
+The feature counts and timings of every month are written to one summary CSV.
+
+usage: python batch_builder.py <folder or glob> [<folder or glob> ...] [--workers N]
+"""
+
+import os
+import glob
+import time
+import argparse
+import logging
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import geopandas as gpd
+from pyproj import CRS
+
+from build_manifest import BuildManifest
+from gtfs_feed_store import preload_counties, shared_store
+from reference_data import pin_snapshot
+from layer_writers import output_formats
+from pipeline_scheduler import pipeline_jobs, run_jobs
+import mta_gtfs_shapefiles_maker as maker
+
+# configure logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+summary_columns = ["folder", "step", "output", "features", "seconds"]
+
+
+def month_year(folder):
+    """Return the month and year used in layer names for a folder name
+
+    e.g. "may2020" -> "May2020", "Apr2020" -> "April2020"
+    """
+    for date_format in ("%B%Y", "%b%Y"):
+        try:
+            date = datetime.strptime(folder, date_format)
+        except ValueError:
+            continue
+        return f"{date:%B}{date.year}"
+    raise ValueError(f"Can't read a month and year from the folder name {folder!r}")
+
+
+def month_folders(path, patterns):
+    """Return the month folders matching folder names or glob patterns, in order
+
+    Only folders named after a month (see month_year) are returned.
+    """
+    folders = []
+    for pattern in patterns:
+        for folder_path in sorted(glob.glob(os.path.join(path, pattern))):
+            folder = os.path.basename(folder_path)
+            if not os.path.isdir(folder_path) or folder in folders:
+                continue
+            try:
+                month_year(folder)
+            except ValueError:
+                logger.info(f"Skipped {folder}, it isn't a month folder")
+                continue
+            folders.append(folder)
+    return folders
+
+
+def build_month(
+    path,
+    folder,
+    entrances,
+    trains_at_stops,
+    output_format="shapefile",
+    force=False,
+    archived_entrances=True,
+):
+    """Build every layer of a month folder in the current process
+
+    Params:
+        path(str): Path to the directory where the month folders are stored
+        folder (str): Name of the month folder
+        entrances (DataFrame): subway entrances data
+        trains_at_stops (DataFrame): trains stopping at each subway station
+        output_format (str): Default value "shapefile"; one of layer_writers.output_formats
+        force (bool): Default value False; rebuild the steps the manifest reports as current
+        archived_entrances (bool): Default value True; use the StationEntrances.csv
+            archived in the folder, when there is one, instead of `entrances`
+    Returns:
+        rows (list): dicts with `summary_columns`, one per output of the month
+    """
+    maker.monthYear = month_year(folder)
+    os.makedirs(os.path.join(path, folder, "shapes"), exist_ok=True)
+    archive = os.path.join(path, folder, "StationEntrances.csv")
+    # an existing archive is never rewritten
+    archived = os.path.exists(archive)
+    if archived and archived_entrances:
+        # the month is rebuilt with the entrances it was first built with
+        pin_snapshot("StationEntrances.csv", archive)
+        try:
+            entrances = maker.read_station_entrances(path)
+        finally:
+            pin_snapshot("StationEntrances.csv", None)
+    store = shared_store(path, folder)
+    manifest = BuildManifest(path, folder, store, force=force)
+    jobs = pipeline_jobs(
+        path,
+        folder,
+        output_format=output_format,
+        entrances=entrances,
+        trains_at_stops=trains_at_stops,
+        archive_entrances=not archived,
+    )
+    try:
+        timings = run_jobs(path, folder, jobs, workers=1, manifest=manifest)
+    finally:
+        # the worker goes on with another month
+        store.evict()
+
+    rows = []
+    for step in dict.fromkeys(job.step for job in jobs):
+        if step not in manifest.steps:
+            continue
+        step_jobs = [job for job in jobs if job.step == step]
+        # skipped steps have no timings
+        seconds = None
+        if any(job.name in timings for job in step_jobs):
+            seconds = round(sum(timings.get(job.name, 0.0) for job in step_jobs), 2)
+        # report lines look like "Feature count for <output> = <count>"
+        for line in manifest.report_lines(step):
+            output, _, count = line.split("Feature count for ", 1)[1].rpartition(" = ")
+            rows.append(
+                dict(folder=folder, step=step, output=output, features=int(count), seconds=seconds)
+            )
+    return rows
+
+
+def build_months(
+    path,
+    folders,
+    workers=None,
+    output_format="shapefile",
+    force=False,
+    archived_entrances=True,
+):
+    """Build the layers of several month folders, one month per worker process
+
+    Params:
+        path(str): Path to the directory where the month folders are stored
+        folders (list): names of the month folders
+        workers (int, optional): number of worker processes, defaults to the number of
+            CPUs (at most one per month); with 1 worker the months are built in this process
+        output_format (str): Default value "shapefile"; one of layer_writers.output_formats
+        force (bool): Default value False; rebuild the steps the manifests report as current
+        archived_entrances (bool): Default value True; build each month with the
+            StationEntrances.csv archived in its folder, when there is one
+    Returns:
+        summary (DataFrame): with `summary_columns`, the outputs of every month in
+        `folders` order; seconds is empty for steps that were skipped
+    """
+    workers = min(workers or os.cpu_count(), len(folders)) or 1
+    # static inputs, loaded once for every month
+    counties = gpd.read_file(os.path.join(path, "counties_bndry.geojson")).to_crs(
+        CRS.from_epsg(2263)
+    )
+    # the current entrances are only needed by months without an archived copy
+    entrances = None
+    if not archived_entrances or not all(
+        os.path.exists(os.path.join(path, folder, "StationEntrances.csv")) for folder in folders
+    ):
+        entrances = maker.read_station_entrances(path)
+    trains_at_stops = maker.read_trains_at_stops(path)
+    static = (entrances, trains_at_stops, output_format, force, archived_entrances)
+
+    results = {}
+    start = time.perf_counter()
+    if workers == 1:
+        preload_counties(path, counties)
+        try:
+            for folder in folders:
+                results[folder] = build_month(path, folder, *static)
+        finally:
+            preload_counties(path, None)
+    else:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=preload_counties,
+            initargs=(path, counties),
+        ) as pool:
+            futures = {
+                folder: pool.submit(build_month, path, folder, *static)
+                for folder in folders
+            }
+            for folder, future in futures.items():
+                results[folder] = future.result()
+    print(f"Built {len(folders)} months in {time.perf_counter() - start:.1f}s")
+
+    return pd.DataFrame(
+        [row for folder in folders for row in results[folder]], columns=summary_columns
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Create the shapefiles of several month folders"
+    )
+    parser.add_argument("folders", nargs="+", help="month folders or glob patterns, e.g. '*2020'")
+    parser.add_argument("--path", default=os.getcwd(), help="directory of the month folders")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of months built at the same time (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=list(output_formats),
+        default="shapefile",
+        help="format of the output layers",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="rebuild every layer, even those whose inputs haven't changed",
+    )
+    parser.add_argument(
+        "--stations-csv",
+        metavar="FILE",
+        help="read Stations.csv from this file instead of the MTA site",
+    )
+    parser.add_argument(
+        "--entrances-csv",
+        metavar="FILE",
+        help="read StationEntrances.csv from this file instead of the MTA site and "
+        "the copies archived in the month folders",
+    )
+    parser.add_argument(
+        "--summary",
+        default="batch_summary.csv",
+        help="CSV file the feature counts and timings are written to, relative to --path",
+    )
+    args = parser.parse_args()
+
+    pin_snapshot("Stations.csv", args.stations_csv)
+    pin_snapshot("StationEntrances.csv", args.entrances_csv)
+
+    folders = month_folders(args.path, args.folders)
+    if not folders:
+        parser.error("No month folders found")
+    summary = build_months(
+        args.path,
+        folders,
+        workers=args.workers,
+        output_format=args.format,
+        force=args.force,
+        archived_entrances=args.entrances_csv is None,
+    )
+    summary.to_csv(os.path.join(args.path, args.summary), index=False)
+    with pd.option_context("display.max_rows", None, "display.width", 120):
+        print(summary.groupby("folder", sort=False)[["features", "seconds"]].sum())
@@ -0,0 +1,118 @@
+"""
+Benchmark of the shapefile builders on synthetic feeds of increasing size.
+
+For each scale a synthetic month folder (see synthetic_gtfs.py) is written to
+a temporary directory and every stage is run twice: once for wall time and
+once under tracemalloc for the peak memory it allocates. Each run gets a fresh
+FeedStore without the disk cache, so table parsing is part of the measurement.
+The subway stops and subway entrances builders are left out: they need MTA's
+Stations.csv and StationEntrances.csv (see reference_data), which the
+synthetic month doesn't have.
+
+usage: python benchmarks/bench_builders.py [--scales small medium large] [--csv results.csv]
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+import warnings
+
+import pandas as pd
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_path)
+
+from synthetic_gtfs import write_synthetic_month
+from gtfs_feed_store import FeedStore
+import mta_gtfs_shapefiles_maker as maker
+
+# keyword arguments of write_synthetic_month for each scale
+scales = {
+    "small": dict(routes=10, points_per_shape=100, stops=500, trips_per_shape=5),
+    "medium": dict(routes=40, points_per_shape=300, stops=2000, trips_per_shape=20),
+    "large": dict(routes=120, points_per_shape=600, stops=6000, trips_per_shape=40),
+}
+
+folder = "Synthetic"
+
+
+def stages(path):
+    """Return (name, function) pairs, each function taking a fresh FeedStore"""
+    store = FeedStore(path, folder, disk_cache=False)
+    _, shapes, _ = maker.read_lines_tables(path, folder, "bk_bus", store=store)
+    return [
+        ("read_lines_tables", lambda s: maker.read_lines_tables(path, folder, "bk_bus", store=s)),
+        ("pre_process_stops", lambda s: maker.pre_process_stops(path, folder, "bk_bus", store=s)),
+        ("create_line_segments", lambda s: maker.create_line_segments(shapes)),
+        ("bus_routes", lambda s: maker.make_bus_routes_shapefiles(path, folder, store=s)),
+        ("bus_stops", lambda s: maker.make_bus_stops_shapefiles(path, folder, store=s)),
+        ("routes_LIRR", lambda s: maker.make_rail_routes_shapefiles(path, folder, "LIRR", store=s)),
+        ("routes_metro_north", lambda s: maker.make_rail_routes_shapefiles(path, folder, "metro_north", store=s)),
+        ("routes_nyc_subway", lambda s: maker.make_rail_routes_shapefiles(path, folder, "nyc_subway", store=s)),
+        ("stops_LIRR", lambda s: maker.make_rail_stops_shapefiles(path, folder, "LIRR", store=s)),
+        ("stops_metro_north", lambda s: maker.make_rail_stops_shapefiles(path, folder, "metro_north", store=s)),
+    ]
+
+
+def measure(path, func, memory=True):
+    """Return (wall time in seconds, peak traced memory in MB) of a stage"""
+    start = time.perf_counter()
+    func(FeedStore(path, folder, disk_cache=False))
+    elapsed = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            func(FeedStore(path, folder, disk_cache=False))
+            peak = tracemalloc.get_traced_memory()[1] / 2**20
+        finally:
+            tracemalloc.stop()
+    return elapsed, peak
+
+
+def main(scale_names, csv_path=None, memory=True):
+    results = []
+    print(f"{'scale':<8}{'stage':<22}{'shape pts':>11}{'stop_times':>12}{'time (s)':>10}{'peak (MB)':>11}")
+    for scale in scale_names:
+        with tempfile.TemporaryDirectory() as path:
+            write_synthetic_month(path, folder, **scales[scale])
+            store = FeedStore(path, folder, disk_cache=False)
+            shape_points = len(store.table("bk_bus", "shapes.txt"))
+            stop_times = len(store.table("bk_bus", "stop_times.txt"))
+            for name, func in stages(path):
+                elapsed, peak = measure(path, func, memory=memory)
+                results.append(
+                    {
+                        "scale": scale,
+                        "stage": name,
+                        "shape_points": shape_points,
+                        "stop_times": stop_times,
+                        "seconds": round(elapsed, 4),
+                        "peak_mb": None if peak is None else round(peak, 1),
+                    }
+                )
+                peak_text = "-" if peak is None else f"{peak:.1f}"
+                print(
+                    f"{scale:<8}{name:<22}{shape_points:>11}{stop_times:>12}"
+                    f"{elapsed:>10.3f}{peak_text:>11}"
+                )
+    if csv_path:
+        pd.DataFrame(results).to_csv(csv_path, index=False)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scales", nargs="+", choices=list(scales), default=list(scales))
+    parser.add_argument("--csv", help="write the results to this CSV file")
+    parser.add_argument(
+        "--no-memory", action="store_true", help="skip the tracemalloc runs"
+    )
+    args = parser.parse_args()
+    # keep the builders' CRS and field-name warnings out of the results table
+    warnings.simplefilter("ignore")
+    main(args.scales, args.csv, memory=not args.no_memory)
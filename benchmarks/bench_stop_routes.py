@@ -0,0 +1,90 @@
+"""
+Micro-benchmark of the stop -> route stage of pre_process_stops.
+
+Compares the previous groupby/apply(pd.Series)/melt implementation with
+distinct_pairs on the bus feeds of a checked-in month folder. The folders
+don't include stop_times.txt, so the joined stop_times/trips table is rebuilt
+from the real stops.txt and trips.txt: every route serves a fixed, seeded
+sample of the feed's stops and each of its trips visits all of them.
+
+usage: python benchmarks/bench_stop_routes.py [folder] [repeat]
+"""
+
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_path)
+
+from mta_gtfs_shapefiles_maker import distinct_pairs
+
+bus_services = ["mn_bus", "si_bus", "qn_bus", "bx_bus", "bk_bus", "bus_company"]
+stops_per_route = 60
+
+
+def legacy_stop_routes(df):
+    """stop -> route stage as it was implemented before distinct_pairs"""
+    routes_for_stops = pd.DataFrame(
+        df.groupby("stop_id")["route_id"].agg(lambda x: list(set(x)))
+    ).reset_index()
+    return (
+        routes_for_stops.route_id.apply(pd.Series)
+        .merge(routes_for_stops, left_index=True, right_index=True)
+        .drop(["route_id"], axis=1)
+        .melt(id_vars="stop_id", value_name="route_id")
+        .drop("variable", axis=1)
+        .dropna()
+    )
+
+
+def stop_times_trips(folder, service, seed=0):
+    """Return a stop_id/route_id table shaped like stop_times.txt merged with trips.txt"""
+    stops = pd.read_csv(os.path.join(folder, service, "stops.txt"), usecols=["stop_id"])
+    trips = pd.read_csv(
+        os.path.join(folder, service, "trips.txt"), usecols=["route_id", "trip_id"]
+    )
+    rng = np.random.default_rng(seed)
+    size = min(stops_per_route, len(stops))
+    route_stops = {
+        route: rng.choice(stops["stop_id"].values, size=size, replace=False)
+        for route in trips["route_id"].unique()
+    }
+    return pd.DataFrame(
+        {
+            "stop_id": np.concatenate([route_stops[r] for r in trips["route_id"]]),
+            "route_id": np.repeat(trips["route_id"].values, size),
+        }
+    )
+
+
+def main(folder="Apr2020", repeat=3):
+    folder = os.path.join(repo_path, folder)
+    print(f"{'service':<12}{'rows':>10}{'pairs':>8}{'legacy (s)':>12}{'distinct (s)':>14}{'speedup':>9}")
+    for service in bus_services:
+        if not os.path.exists(os.path.join(folder, service, "trips.txt")):
+            print(f"{service:<12} skipped, no trips.txt")
+            continue
+        df = stop_times_trips(folder, service)
+
+        legacy = legacy_stop_routes(df)
+        fast = distinct_pairs(df["stop_id"], df["route_id"])
+        assert set(zip(legacy.stop_id, legacy.route_id)) == set(zip(fast.stop_id, fast.route_id))
+
+        legacy_time = min(timeit.repeat(lambda: legacy_stop_routes(df), number=1, repeat=repeat))
+        fast_time = min(
+            timeit.repeat(lambda: distinct_pairs(df["stop_id"], df["route_id"]), number=1, repeat=repeat)
+        )
+        print(
+            f"{service:<12}{len(df):>10}{len(fast):>8}{legacy_time:>12.3f}"
+            f"{fast_time:>14.3f}{legacy_time / fast_time:>8.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    folder = sys.argv[1] if len(sys.argv) > 1 else "Apr2020"
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    main(folder, repeat)
@@ -0,0 +1,218 @@
+"""
+Synthetic GTFS feeds laid out like an MTA month folder.
+
+Writes one folder per service (bk_bus, bx_bus, ..., LIRR, metro_north,
+nyc_subway) with routes, shapes, trips, stops, stop_times and calendar tables
+whose sizes are set by the parameters, plus the counties layer the builders
+clip to. Coordinates fall inside New York City so the layers survive the
+county clip; route ids follow the MTA conventions the builders rely on
+(local vs express bus ids, subway route groups and "<route>..<dir>" shape ids,
+numeric Metro-North stop ids).
+
+usage: python benchmarks/synthetic_gtfs.py <path> <folder> [routes] [points_per_shape] [stops]
+"""
+
+import os
+import shutil
+import sys
+
+import numpy as np
+import pandas as pd
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+bus_prefixes = {
+    "mn_bus": "M",
+    "si_bus": "S",
+    "qn_bus": "Q",
+    "bx_bus": "BX",
+    "bk_bus": "B",
+    "bus_company": "QM",
+}
+subway_routes = ["1", "2", "3", "4", "5", "6", "7", "A", "C", "E", "B", "D", "F", "M", "G", "J", "L", "N", "Q", "R", "W"]
+
+# lon/lat box inside NYC
+lon_range = (-74.02, -73.78)
+lat_range = (40.60, 40.85)
+
+
+def route_ids(service, n_routes):
+    """Return route ids for a service: bus services get local and express ids"""
+    if service == "nyc_subway":
+        return subway_routes[:n_routes]
+    if service in bus_prefixes:
+        prefix = bus_prefixes[service]
+        # every fourth route is an express route, e.g. "BXM3"
+        return [
+            f"{prefix}M{i}" if i % 4 == 3 and not prefix.endswith("M") else f"{prefix}{i}"
+            for i in range(1, n_routes + 1)
+        ]
+    return [str(i) for i in range(1, n_routes + 1)]
+
+
+def write_service(
+    service_path,
+    service,
+    rng,
+    n_routes,
+    shapes_per_route,
+    points_per_shape,
+    n_stops,
+    trips_per_shape,
+    stops_per_trip,
+):
+    os.makedirs(service_path, exist_ok=True)
+    routes = route_ids(service, n_routes)
+
+    pd.DataFrame(
+        {
+            "agency_id": "MTA",
+            "route_id": routes,
+            "route_short_name": routes,
+            "route_long_name": [f"Route {r}" for r in routes],
+            "route_type": 3,
+            "route_color": [f"{rng.integers(0, 0xFFFFFF):06X}" for _ in routes],
+        }
+    ).to_csv(os.path.join(service_path, "routes.txt"), index=False)
+
+    # shapes: random walks, shape ids unique across services
+    shape_ids = []
+    shape_routes = []
+    shape_dirs = []
+    for route in routes:
+        for k in range(shapes_per_route):
+            direction = k % 2
+            if service == "nyc_subway":
+                shape_ids.append(f"{route}..{'NS'[direction]}{k:02d}X")
+            else:
+                shape_ids.append(f"{service}_{route}_{k}")
+            shape_routes.append(route)
+            shape_dirs.append(direction)
+    n_shapes = len(shape_ids)
+    start_lon = rng.uniform(*lon_range, n_shapes)
+    start_lat = rng.uniform(*lat_range, n_shapes)
+    steps = rng.normal(0, 0.0005, (n_shapes, points_per_shape, 2)).cumsum(axis=1)
+    lon = np.clip(start_lon[:, None] + steps[:, :, 0], *lon_range)
+    lat = np.clip(start_lat[:, None] + steps[:, :, 1], *lat_range)
+    pd.DataFrame(
+        {
+            "shape_id": np.repeat(shape_ids, points_per_shape),
+            "shape_pt_sequence": np.tile(np.arange(1, points_per_shape + 1), n_shapes),
+            "shape_pt_lat": lat.ravel().round(6),
+            "shape_pt_lon": lon.ravel().round(6),
+        }
+    ).to_csv(os.path.join(service_path, "shapes.txt"), index=False)
+
+    # stops
+    if service == "metro_north":
+        # ids below 500 are train stations, 500-1000 shuttle bus stops
+        stop_ids = [str(i) for i in range(1, n_stops + 1)]
+    else:
+        stop_ids = [str(100000 + i) for i in range(n_stops)]
+    pd.DataFrame(
+        {
+            "stop_id": stop_ids,
+            "stop_name": [f"STOP {i}" for i in range(n_stops)],
+            "stop_lat": rng.uniform(*lat_range, n_stops).round(6),
+            "stop_lon": rng.uniform(*lon_range, n_stops).round(6),
+        }
+    ).to_csv(os.path.join(service_path, "stops.txt"), index=False)
+
+    # trips and stop_times: each route serves a fixed sample of stops
+    route_stops = {
+        route: rng.choice(stop_ids, size=min(stops_per_trip, n_stops), replace=False)
+        for route in routes
+    }
+    trip_ids = [f"{shape_id}_T{t}" for shape_id in shape_ids for t in range(trips_per_shape)]
+    trips = pd.DataFrame(
+        {
+            "route_id": np.repeat(shape_routes, trips_per_shape),
+            "service_id": np.tile(["Weekday", "Saturday", "Sunday"], len(trip_ids))[: len(trip_ids)],
+            "trip_id": trip_ids,
+            "trip_headsign": "SYNTHETIC",
+            "direction_id": np.repeat(shape_dirs, trips_per_shape),
+            "shape_id": np.repeat(shape_ids, trips_per_shape),
+        }
+    )
+    trips.to_csv(os.path.join(service_path, "trips.txt"), index=False)
+
+    n_trip_stops = min(stops_per_trip, n_stops)
+    starts = rng.integers(4 * 3600, 25 * 3600, len(trips))
+    seconds = (starts[:, None] + np.arange(n_trip_stops) * 90).ravel()
+    times = [f"{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}" for s in seconds]
+    pd.DataFrame(
+        {
+            "trip_id": np.repeat(trips["trip_id"].values, n_trip_stops),
+            "arrival_time": times,
+            "departure_time": times,
+            "stop_id": np.concatenate([route_stops[r] for r in trips["route_id"]]),
+            "stop_sequence": np.tile(np.arange(1, n_trip_stops + 1), len(trips)),
+        }
+    ).to_csv(os.path.join(service_path, "stop_times.txt"), index=False)
+
+    pd.DataFrame(
+        {
+            "service_id": ["Weekday", "Saturday", "Sunday"],
+            "monday": [1, 0, 0],
+            "tuesday": [1, 0, 0],
+            "wednesday": [1, 0, 0],
+            "thursday": [1, 0, 0],
+            "friday": [1, 0, 0],
+            "saturday": [0, 1, 0],
+            "sunday": [0, 0, 1],
+            "start_date": 20200101,
+            "end_date": 20201231,
+        }
+    ).to_csv(os.path.join(service_path, "calendar.txt"), index=False)
+
+
+def write_synthetic_month(
+    path,
+    folder,
+    routes=20,
+    shapes_per_route=4,
+    points_per_shape=200,
+    stops=2000,
+    trips_per_shape=20,
+    stops_per_trip=40,
+    seed=0,
+):
+    """Write a synthetic month folder with every MTA service
+
+    Params:
+        path(str): Path to the directory where the month folder is created
+        folder (str): Name of the month folder
+        routes (int): number of routes per service (subway is capped at its real routes)
+        shapes_per_route (int): number of shapes per route
+        points_per_shape (int): number of points of each shape
+        stops (int): number of stops per service
+        trips_per_shape (int): number of trips following each shape
+        stops_per_trip (int): number of stops served by each trip
+        seed (int): seed of the random generator
+    """
+    rng = np.random.default_rng(seed)
+    for service in list(bus_prefixes) + ["LIRR", "metro_north", "nyc_subway"]:
+        write_service(
+            os.path.join(path, folder, service),
+            service,
+            rng,
+            routes,
+            shapes_per_route,
+            points_per_shape,
+            stops,
+            trips_per_shape,
+            stops_per_trip,
+        )
+    os.makedirs(os.path.join(path, folder, "shapes"), exist_ok=True)
+    shutil.copy(
+        os.path.join(repo_path, "counties_bndry.geojson"),
+        os.path.join(path, "counties_bndry.geojson"),
+    )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        sys.exit(__doc__)
+    sizes = [int(a) for a in sys.argv[3:6]]
+    kwargs = dict(zip(["routes", "points_per_shape", "stops"], sizes))
+    write_synthetic_month(sys.argv[1], sys.argv[2], **kwargs)
@@ -0,0 +1,132 @@
+"""
+Build manifest used to skip layers whose inputs haven't changed.
+
+For every build step (e.g. "routes_LIRR" or "bus_stops") the manifest records
+a fingerprint of each input table and file, a fingerprint of the code and the
+parameters the step ran with, and the feature report lines it wrote. A step is
+current, and can be skipped, when all of these are unchanged and the layers it
+reported still exist in the 'shapes' folder.
+"""
+
+import os
+import glob
+import json
+import hashlib
+import logging
+
+import pandas as pd
+
+from gtfs_feed_store import file_digest
+from layer_writers import output_exists
+
+# configure logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+manifest_name = "build_manifest.json"
+
+
+def code_version():
+    """Return a fingerprint of the Python modules next to this file"""
+    digest = hashlib.sha1()
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    for module in sorted(glob.glob(os.path.join(code_dir, "*.py"))):
+        digest.update(os.path.basename(module).encode())
+        digest.update(file_digest(module).encode())
+    return digest.hexdigest()
+
+
+def frame_fingerprint(df):
+    """Return a fingerprint of the content of a DataFrame"""
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    digest = hashlib.sha1(",".join(map(str, df.columns)).encode())
+    digest.update(row_hashes.tobytes())
+    return digest.hexdigest()
+
+
+class BuildManifest:
+    """Manifest of the steps built in a data folder, stored in build_manifest.json
+
+    Params:
+        path(str): Path to the directory where GTFS data is stored
+        folder (str): Name of the folder where the GTFS data is stored
+        store (FeedStore): store used to fingerprint the input tables
+        force (bool): Default value False; report every step as out of date
+    """
+
+    def __init__(self, path, folder, store, force=False):
+        self.path = path
+        self.folder = folder
+        self.store = store
+        self.force = force
+        self.manifest_path = os.path.join(path, folder, manifest_name)
+        self.steps = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.steps = json.load(f).get("steps", {})
+        self._code_version = code_version()
+
+    def fingerprint(self, inputs):
+        """Return the fingerprints of a step's inputs
+
+        Params:
+            inputs (list): (service, table name) tuples for GTFS tables, paths relative
+                to `path` for other files, or (name, DataFrame) tuples for data read elsewhere
+        Returns:
+            fingerprints (dict): fingerprint of each input, "missing" for absent tables and files
+        """
+        fingerprints = {}
+        for item in inputs:
+            if isinstance(item, tuple) and isinstance(item[1], pd.DataFrame):
+                fingerprints[item[0]] = frame_fingerprint(item[1])
+            elif isinstance(item, tuple):
+                service, name = item
+                fingerprints[f"{service}/{name}"] = (
+                    self.store.source_key(service, name)
+                    if self.store.has_table(service, name)
+                    else "missing"
+                )
+            else:
+                file_path = os.path.join(self.path, item)
+                fingerprints[item] = (
+                    f"{os.path.getsize(file_path)}-{file_digest(file_path)[:16]}"
+                    if os.path.exists(file_path)
+                    else "missing"
+                )
+        return fingerprints
+
+    def is_current(self, step, fingerprints, params):
+        """Return True if the step can be skipped"""
+        if self.force or step not in self.steps:
+            return False
+        entry = self.steps[step]
+        if (
+            entry["inputs"] != fingerprints
+            or entry["code"] != self._code_version
+            or entry["params"] != params
+        ):
+            return False
+        shapes_dir = os.path.join(self.path, self.folder, "shapes")
+        return all(output_exists(shapes_dir, output) for output in entry["outputs"])
+
+    def report_lines(self, step):
+        """Return the feature report lines written when the step was last built"""
+        return self.steps[step]["report"]
+
+    def record(self, step, fingerprints, params, report_lines):
+        """Record a step that was just built"""
+        self.steps[step] = {
+            "inputs": fingerprints,
+            "code": self._code_version,
+            "params": params,
+            # report lines look like "Feature count for <output> = <count>"
+            "outputs": [
+                line.split("Feature count for ", 1)[1].rsplit(" = ", 1)[0]
+                for line in report_lines
+            ],
+            "report": report_lines,
+        }
+
+    def save(self):
+        with open(self.manifest_path, "w") as f:
+            json.dump({"steps": self.steps}, f, indent=2)
@@ -0,0 +1,130 @@
+"""
+Bulk point-in-county lookup used to clip stops and entrances to the counties layer.
+
+The counties are indexed once in an STRtree of prepared geometries. A grid laid
+over the counties is classified up front: cells that touch no county, and
+cells that lie in the interior of a single county and touch no other, answer
+the points falling in them directly. Only points in the remaining cells, along
+county boundaries and the shoreline, are tested against the polygons.
+"""
+
+import numpy as np
+import shapely
+
+from stage_profiler import profiled
+
+
+class CountyLookup:
+    """Point-in-county lookup over a counties GeoDataFrame
+
+    Params:
+        counties (GeoDataFrame): county polygons, in the coordinate system of the queried points
+        grid_size (int): Default value 128; number of precheck cells along each axis
+    """
+
+    def __init__(self, counties, grid_size=128):
+        self.counties = counties
+        self.geometries = np.asarray(counties.geometry.values, dtype=object)
+        shapely.prepare(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+
+        xmin, ymin, xmax, ymax = shapely.total_bounds(self.geometries)
+        self.origin = (xmin, ymin)
+        self.bounds = (xmin, ymin, xmax, ymax)
+        self.grid_size = grid_size
+        self.cell_size = (
+            max(xmax - xmin, 1e-9) / grid_size,
+            max(ymax - ymin, 1e-9) / grid_size,
+        )
+        self.cells = self._classify_cells()
+
+    def _classify_cells(self):
+        """Return the county of each grid cell: its index when the cell is in the interior
+        of that county only, -1 when the cell touches no county and -2 otherwise"""
+        n = self.grid_size
+        ix, iy = np.meshgrid(np.arange(n), np.arange(n), indexing="ij")
+        ix, iy = ix.ravel(), iy.ravel()
+        width, height = self.cell_size
+        # grow cells slightly so points on a cell edge are always inside the tested box
+        pad_x, pad_y = width * 1e-6, height * 1e-6
+        boxes = shapely.box(
+            self.origin[0] + ix * width - pad_x,
+            self.origin[1] + iy * height - pad_y,
+            self.origin[0] + (ix + 1) * width + pad_x,
+            self.origin[1] + (iy + 1) * height + pad_y,
+        )
+        cell_idx, county_idx = self.tree.query(boxes, predicate="intersects")
+        counts = np.bincount(cell_idx, minlength=len(boxes))
+
+        cells = np.full(len(boxes), -2, dtype=np.int64)
+        cells[counts == 0] = -1
+        single = np.flatnonzero(counts[cell_idx] == 1)
+        inside = shapely.contains_properly(
+            self.geometries[county_idx[single]], boxes[cell_idx[single]]
+        )
+        cells[cell_idx[single][inside]] = county_idx[single][inside]
+        return cells.reshape(n, n)
+
+    def query(self, x, y):
+        """Find the counties intersecting each point
+
+        Params:
+            x, y (array): point coordinates
+        Returns:
+            point_idx, county_idx (tuple): arrays of matching (point, county) positions,
+            sorted by point; a point on the boundary between counties matches each
+            of them and a point outside every county has no match
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        width, height = self.cell_size
+        # points on the xmax/ymax edge of the grid belong to its last cells
+        last = self.grid_size - 1
+        ix = np.minimum(np.floor((x - self.origin[0]) / width), last)
+        iy = np.minimum(np.floor((y - self.origin[1]) / height), last)
+        in_grid = (ix >= 0) & (iy >= 0) & (x <= self.bounds[2]) & (y <= self.bounds[3])
+
+        state = np.full(len(x), -1, dtype=np.int64)
+        state[in_grid] = self.cells[ix[in_grid].astype(np.int64), iy[in_grid].astype(np.int64)]
+
+        resolved = np.flatnonzero(state >= 0)
+        undecided = np.flatnonzero(state == -2)
+        exact_points, exact_counties = self.tree.query(
+            shapely.points(x[undecided], y[undecided]), predicate="intersects"
+        )
+
+        point_idx = np.concatenate([resolved, undecided[exact_points]])
+        county_idx = np.concatenate([state[resolved], exact_counties])
+        # the counties of a point on a boundary stay in the order the tree returns them,
+        # which is the order gpd.sjoin gives
+        order = np.argsort(point_idx, kind="stable")
+        return point_idx[order], county_idx[order]
+
+
+@profiled("sjoin")
+def sjoin_counties(gdf, lookup):
+    """Inner spatial join of a point GeoDataFrame with the counties of a CountyLookup
+
+    Gives the same rows as gpd.sjoin(gdf, counties, how="inner", predicate="intersects")
+    followed by dropping the "index_right" column.
+
+    Params:
+        gdf (GeoDataFrame): points in the coordinate system of the counties
+        lookup (CountyLookup): lookup built over the counties
+    Returns:
+        gdf: (GeoDataFrame) points with the attributes of the county they fall in
+    """
+    geometries = gdf.geometry.values
+    if len(gdf) and not (shapely.get_type_id(geometries) == 0).all():
+        raise ValueError("sjoin_counties only supports point geometries")
+
+    point_idx, county_idx = lookup.query(shapely.get_x(geometries), shapely.get_y(geometries))
+    joined = gdf.iloc[point_idx].copy()
+    attributes = lookup.counties.drop(columns=lookup.counties.geometry.name)
+    for column in attributes.columns:
+        name = column
+        if column in joined.columns:
+            joined = joined.rename(columns={column: f"{column}_left"})
+            name = f"{column}_right"
+        joined[name] = attributes[column].to_numpy()[county_idx]
+    return joined
@@ -0,0 +1,312 @@
+"""
+Compares the GTFS feeds of two month folders, e.g. october2019 and may2020.
+
+For every service folder (bk_bus, LIRR, nyc_subway, ...) the routes, stops,
+trips and shapes tables are compared by ID: rows are reduced to one hash per
+ID (per shape_id for shapes, over all the points of the shape) and the IDs
+are compared as sets, so no row is compared with another one by one. Routes
+active in trips.txt are compared as well, since routes.txt can list routes
+without service.
+
+The result is a summary with the counts of added, removed and changed IDs per
+service and table, and the list of changed IDs with, for changed rows, the
+columns that differ. A table only one of the months has is marked in the
+`missing` column of the summary, with no row count for that month.
+
+The month folders are only read: parsed tables aren't cached in them.
+
+usage: python gtfs_feed_diff.py <old folder> <new folder> [more folders...] [--output DIR]
+"""
+
+import os
+import sys
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+
+from gtfs_feed_store import FeedStore
+
+# configure logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# table -> (ID column, compared columns); shapes are compared point by point
+diff_tables = {
+    "routes.txt": (
+        "route_id",
+        ["agency_id", "route_short_name", "route_long_name", "route_type", "route_color"],
+    ),
+    "stops.txt": (
+        "stop_id",
+        ["stop_name", "stop_lat", "stop_lon", "location_type", "parent_station"],
+    ),
+    "trips.txt": (
+        "trip_id",
+        ["route_id", "service_id", "trip_headsign", "direction_id", "shape_id"],
+    ),
+    "shapes.txt": ("shape_id", ["shape_pt_sequence", "shape_pt_lat", "shape_pt_lon"]),
+}
+# pseudo table of the route ids found in trips.txt
+active_routes = "active_routes"
+
+summary_columns = ["service", "table", "old", "new", "added", "removed", "changed", "missing"]
+change_columns = ["service", "table", "change", "id", "columns"]
+
+
+def feed_services(path, folder):
+    """Return the names of the service folders of a month folder"""
+    folder_path = os.path.join(path, folder)
+    return sorted(
+        name
+        for name in os.listdir(folder_path)
+        if os.path.isdir(os.path.join(folder_path, name))
+        and name != "shapes"
+        and not name.startswith(".")
+    )
+
+
+def comparable(df, columns, numeric):
+    """Return the columns in a type that compares equal across months
+
+    Columns in `numeric` (numeric in both months) are compared as floats and
+    the others as text, with missing values as empty text, so that a column
+    parsed as a number in one month and as text in the other doesn't show as changed.
+    """
+    return pd.DataFrame(
+        {
+            column: df[column].astype("float64")
+            if column in numeric
+            else df[column].astype(str).mask(df[column].isna(), "")
+            for column in columns
+        },
+        index=df.index,
+    )
+
+
+def row_hashes(df, key, columns, numeric=()):
+    """Return one hash per ID of the compared columns, indexed by ID"""
+    ids = df[key].astype(str)
+    keep = ~ids.duplicated().to_numpy()
+    if not columns:
+        return pd.Series(np.zeros(keep.sum(), dtype="uint64"), index=pd.Index(ids[keep], name="id"))
+    values = comparable(df.loc[keep], columns, numeric)
+    hashes = pd.util.hash_pandas_object(values, index=False).to_numpy()
+    return pd.Series(hashes, index=pd.Index(ids[keep], name="id"))
+
+
+def shape_hashes(shapes):
+    """Return one hash per shape_id over all its points, indexed by shape_id"""
+    hashes = pd.util.hash_pandas_object(
+        shapes[["shape_pt_sequence", "shape_pt_lat", "shape_pt_lon"]], index=False
+    )
+    # the sequence number is part of each point's hash, so the (wrapping) sum
+    # changes when points are added, removed, moved or reordered
+    return hashes.groupby(shapes["shape_id"].astype(str).to_numpy()).sum().rename_axis("id")
+
+
+def diff_hashes(old, new):
+    """Compare two hash Series indexed by ID
+
+    Returns:
+        added, removed, changed (tuple): Index of the IDs only in new, only in old,
+        and in both with a different hash
+    """
+    added = new.index.difference(old.index)
+    removed = old.index.difference(new.index)
+    common = old.index.intersection(new.index)
+    changed = common[old.reindex(common).to_numpy() != new.reindex(common).to_numpy()]
+    return added, removed, changed
+
+
+def changed_columns(old, new, key, columns, ids, numeric=()):
+    """Return, for each changed ID, the comma separated names of the columns that differ"""
+    old = old.assign(**{key: old[key].astype(str)}).drop_duplicates(key).set_index(key)
+    new = new.assign(**{key: new[key].astype(str)}).drop_duplicates(key).set_index(key)
+    old = comparable(old.loc[ids], columns, numeric)
+    new = comparable(new.loc[ids], columns, numeric)
+    differs = ~((old == new) | (old.isna() & new.isna())).to_numpy()
+    names = np.array(columns)
+    return [",".join(names[row]) for row in differs]
+
+
+def load_table(store, service, name):
+    """Return a table of a service, or None when the service doesn't have it"""
+    if store is None or not store.has_table(service, name):
+        return None
+    return store.table(service, name)
+
+
+def diff_table(old, new, name):
+    """Compare one table of a service between two months
+
+    Params:
+        old, new (DataFrame): the table in each month, None when missing
+        name (str): table name, a key of `diff_tables` or `active_routes`
+    Returns:
+        counts, changes (tuple): dict of counts and DataFrame with change, id and columns;
+        the count of a missing table is None, and `missing` names the month without it
+        ("old" or "new", empty when both have it)
+    """
+    if name == active_routes:
+        key, columns = "route_id", []
+    else:
+        key, columns = diff_tables[name]
+    frames = [df for df in (old, new) if df is not None]
+    # only compare columns both months have
+    columns = [c for c in columns if all(c in df.columns for df in frames)]
+    numeric = {
+        c for c in columns if all(pd.api.types.is_numeric_dtype(df[c]) for df in frames)
+    }
+
+    def hashes(df):
+        if df is None:
+            return pd.Series([], index=pd.Index([], name="id"), dtype="uint64")
+        if name == "shapes.txt":
+            return shape_hashes(df)
+        return row_hashes(df, key, columns, numeric)
+
+    old_hashes, new_hashes = hashes(old), hashes(new)
+    added, removed, changed = diff_hashes(old_hashes, new_hashes)
+    counts = {
+        "old": None if old is None else len(old_hashes),
+        "new": None if new is None else len(new_hashes),
+        "added": len(added),
+        "removed": len(removed),
+        "changed": len(changed),
+        "missing": "old" if old is None else "new" if new is None else "",
+    }
+    if len(changed) and name == "shapes.txt":
+        detail = ["points"] * len(changed)
+    elif len(changed):
+        detail = changed_columns(old, new, key, columns, changed, numeric)
+    else:
+        detail = []
+    changes = pd.DataFrame(
+        {
+            "change": np.repeat(
+                ["added", "removed", "changed"], [len(added), len(removed), len(changed)]
+            ),
+            "id": np.concatenate(
+                [ids.to_numpy(dtype=object) for ids in (added, removed, changed)]
+            ),
+            "columns": [""] * (len(added) + len(removed)) + list(detail),
+        }
+    )
+    return counts, changes
+
+
+def diff_stores(old_store, new_store, services=None, tables=None):
+    """Compare the feeds of two FeedStores
+
+    Params:
+        old_store, new_store (FeedStore): stores of the older and newer month folders
+        services (list, optional): services to compare, defaults to those of either folder
+        tables (list, optional): tables to compare, defaults to all of `diff_tables`
+            and `active_routes`
+    Returns:
+        summary, changes (tuple): DataFrames with `summary_columns` and `change_columns`
+    """
+    if services is None:
+        services = sorted(
+            set(feed_services(old_store.path, old_store.folder))
+            | set(feed_services(new_store.path, new_store.folder))
+        )
+    tables = tables or list(diff_tables) + [active_routes]
+
+    summary = []
+    changes = []
+    for service in services:
+        for name in tables:
+            table_name = "trips.txt" if name == active_routes else name
+            old = load_table(old_store, service, table_name)
+            new = load_table(new_store, service, table_name)
+            if old is None and new is None:
+                continue
+            counts, table_changes = diff_table(old, new, name)
+            summary.append(dict(service=service, table=name, **counts))
+            table_changes.insert(0, "table", name)
+            table_changes.insert(0, "service", service)
+            changes.append(table_changes)
+    summary = pd.DataFrame(summary, columns=summary_columns)
+    # missing tables have no row count rather than 0 rows
+    summary[["old", "new"]] = summary[["old", "new"]].astype("Int64")
+    return (
+        summary,
+        pd.concat(changes, ignore_index=True) if changes else pd.DataFrame(columns=change_columns),
+    )
+
+
+def diff_feeds(path, old_folder, new_folder, services=None, tables=None):
+    """Compare the feeds of two month folders
+
+    Params:
+        path(str): Path to the directory where the month folders are stored
+        old_folder, new_folder (str): names of the older and newer month folders
+        services, tables (list, optional): see diff_stores
+    Returns:
+        summary, changes (tuple): DataFrames with `summary_columns` and `change_columns`
+    """
+    return diff_stores(
+        FeedStore(path, old_folder, disk_cache=False),
+        FeedStore(path, new_folder, disk_cache=False),
+        services,
+        tables,
+    )
+
+
+def diff_series(path, folders, services=None, tables=None):
+    """Compare each month folder with the previous one, e.g. a year of monthly archives
+
+    Each folder's tables are parsed once and released after its second comparison.
+
+    Returns:
+        summary, changes (tuple): DataFrames as returned by diff_stores, with
+        "old_folder" and "new_folder" columns added in front
+    """
+    summaries = []
+    all_changes = []
+    previous = None
+    for folder in folders:
+        store = FeedStore(path, folder, disk_cache=False)
+        if previous is not None:
+            summary, changes = diff_stores(previous, store, services, tables)
+            for df in (summary, changes):
+                df.insert(0, "new_folder", folder)
+                df.insert(0, "old_folder", previous.folder)
+            summaries.append(summary)
+            all_changes.append(changes)
+            previous.evict()
+        previous = store
+    if not summaries:
+        return (
+            pd.DataFrame(columns=["old_folder", "new_folder"] + summary_columns),
+            pd.DataFrame(columns=["old_folder", "new_folder"] + change_columns),
+        )
+    return pd.concat(summaries, ignore_index=True), pd.concat(all_changes, ignore_index=True)
+
+
+def write_diff_report(summary, changes, output_dir, name="feed_diff"):
+    """Write a diff to <name>_summary.csv and <name>_changes.csv in output_dir"""
+    os.makedirs(output_dir, exist_ok=True)
+    summary.to_csv(os.path.join(output_dir, f"{name}_summary.csv"), index=False)
+    changes.to_csv(os.path.join(output_dir, f"{name}_changes.csv"), index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the GTFS feeds of month folders, each with the previous one"
+    )
+    parser.add_argument("folders", nargs="+", help="month folders, oldest first")
+    parser.add_argument("--path", default=os.getcwd(), help="directory of the month folders")
+    parser.add_argument("--output", help="write the summary and changes CSVs to this directory")
+    args = parser.parse_args()
+    if len(args.folders) < 2:
+        sys.exit("Give at least two month folders")
+
+    summary, changes = diff_series(args.path, args.folders)
+    with pd.option_context("display.max_rows", None, "display.width", 120):
+        print(summary.to_string(index=False))
+    if args.output:
+        write_diff_report(summary, changes, args.output)
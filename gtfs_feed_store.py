@@ -0,0 +1,311 @@
+import pandas as pd
+import os
+import glob
+import hashlib
+import zipfile
+import tempfile
+from contextlib import contextmanager
+import logging
+
+from stage_profiler import profile_stage
+from route_catalog import RouteCatalog
+
+try:
+    # parquet engine used by the on-disk cache of parsed tables
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# configure logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# dtypes used for every read of a given GTFS table, so that all builders
+# sharing a parsed table see the same column types
+table_dtypes = {
+    "routes.txt": {"route_id": str},
+    "shapes.txt": {"shape_id": str},
+    "trips.txt": {"route_id": str, "shape_id": str, "trip_id": str},
+    "stop_times.txt": {"trip_id": str},
+}
+
+# name of the folder, created next to each source table, holding parsed copies
+cache_folder = ".gtfs_cache"
+
+# version of the parsed copies, bump it when the way tables are parsed changes
+cache_version = 1
+
+
+def file_digest(file_path, block_size=1 << 20):
+    """Return the sha1 hex digest of a file's content"""
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class FeedStore:
+    """Per-run store of parsed GTFS tables for a single data folder.
+
+    Each table is read from disk the first time it is requested and kept in
+    memory for the rest of the run, so builders that need the same table
+    (e.g. trips.txt for routes and for stops) parse it only once. The same
+    applies to the counties boundary layer, which is kept reprojected to
+    NY State Plane, and to the route catalog of each service (see route_catalog).
+
+    Tables returned by the store are shared between callers and should be
+    treated as read-only.
+
+    A table is read from its extracted text file when there is one, otherwise
+    straight out of the service's feed zip (e.g. LIRR/LIRR.zip), so feeds don't
+    need to be extracted.
+
+    With `disk_cache` on, every parsed table is also saved in Parquet format in
+    a `.gtfs_cache` folder next to its source file. The cached copy is keyed by
+    the size and sha1 of the source (size and CRC for a table read from a zip),
+    the options it is parsed with and `cache_version`, so a rerun against the
+    same folder skips CSV parsing, and a changed source file or parser is
+    parsed again and re-cached.
+
+    Params:
+        path(str): Path to the directory where GTFS data is stored
+        folder (str): Name of the folder where the GTFS data is stored
+        disk_cache (bool): Default value True; keep parsed tables on disk between runs.
+            Ignored when pyarrow is not installed.
+    """
+
+    def __init__(self, path, folder, disk_cache=True):
+        self.path = path
+        self.folder = folder
+        self.disk_cache = disk_cache and pyarrow is not None
+        self._tables = {}
+        self._counties = None
+        self._county_lookup = None
+        self._route_catalogs = {}
+
+    def table_path(self, service, name):
+        """Return the path of the `name` table (e.g. "trips.txt") of the given service"""
+        return os.path.join(self.path, self.folder, service, name)
+
+    def zip_path(self, service):
+        """Return the path of the feed zip of the given service"""
+        return os.path.join(self.path, self.folder, service, f"{service}.zip")
+
+    def has_table(self, service, name):
+        """Return True if the table exists, extracted or in the feed zip"""
+        try:
+            self._source(service, name)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def source_key(self, service, name):
+        """Return a key identifying the content of a table: its size and sha1, or its
+        size and CRC when it is read from the feed zip"""
+        source, key = self._source(service, name)
+        if key is None:
+            key = f"{os.path.getsize(source)}-{file_digest(source)[:16]}"
+        return key
+
+    def _source(self, service, name):
+        """Return (path, key) of a table, key identifies the version of a table read
+        from the feed zip and is None for an extracted file
+
+        path is the extracted text file, or the feed zip when the table is only in the zip.
+        """
+        file_path = self.table_path(service, name)
+        if os.path.exists(file_path):
+            return file_path, None
+        zip_path = self.zip_path(service)
+        if os.path.exists(zip_path):
+            with zipfile.ZipFile(zip_path) as zip_ref:
+                if name in zip_ref.namelist():
+                    info = zip_ref.getinfo(name)
+                    return zip_path, f"{info.file_size}-{info.CRC:08x}"
+        raise FileNotFoundError(f"No {name} for {service} in {self.folder}")
+
+    @contextmanager
+    def open_table(self, service, name):
+        """Open the `name` table of the given service for binary reading, from the zip if needed"""
+        source, _ = self._source(service, name)
+        if source.endswith(".zip"):
+            with zipfile.ZipFile(source) as zip_ref, zip_ref.open(name) as f:
+                yield f
+        else:
+            with open(source, "rb") as f:
+                yield f
+
+    def table(self, service, name):
+        """Return the parsed `name` table of the given service, reading it on first use
+
+        Params:
+            service (str): name of the service folder, e.g. "bx_bus" or "LIRR"
+            name (str): file name of the GTFS table, e.g. "trips.txt"
+        Returns:
+            df: (DataFrame) parsed table
+        """
+        key = (service, name)
+        if key not in self._tables:
+            with profile_stage("read", service=service, table=name) as stage:
+                self._tables[key] = stage.output(self._read_table(service, name))
+        return self._tables[key]
+
+    def _read_options(self, name):
+        """Return the read_csv options of a table, part of the key of its cached copy"""
+        return {"dtype": table_dtypes.get(name)}
+
+    def _read_csv(self, service, name):
+        with self.open_table(service, name) as f:
+            return pd.read_csv(f, **self._read_options(name))
+
+    def _read_table(self, service, name):
+        if not self.disk_cache:
+            return self._read_csv(service, name)
+
+        source, _ = self._source(service, name)
+        key = self.source_key(service, name)
+        options = repr((cache_version, sorted(self._read_options(name).items())))
+        options_key = hashlib.sha1(options.encode()).hexdigest()[:8]
+        cache_dir = os.path.join(os.path.dirname(source), cache_folder)
+        cache_file = os.path.join(cache_dir, f"{name}.{key}.{options_key}.parquet")
+        if os.path.exists(cache_file):
+            logger.info(f"Read cached {name} for {service} in {self.folder}")
+            return pd.read_parquet(cache_file)
+
+        df = self._read_csv(service, name)
+        temp_file = None
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # remove copies made from earlier versions of the source file or parser
+            for stale in glob.glob(os.path.join(cache_dir, f"{name}.*.parquet")):
+                os.remove(stale)
+            # written under a unique name, so that processes caching the same
+            # table don't write into each other's file
+            with tempfile.NamedTemporaryFile(
+                dir=cache_dir, prefix=f"{name}.", suffix=".tmp", delete=False
+            ) as f:
+                temp_file = f.name
+            df.to_parquet(temp_file, index=False)
+            os.replace(temp_file, cache_file)
+        except Exception:
+            # caching is an optimization only; the parsed table is still returned
+            logger.warning(f"Could not cache {name} for {service}", exc_info=True)
+            if temp_file is not None and os.path.exists(temp_file):
+                os.remove(temp_file)
+        return df
+
+    def iter_table(self, service, name, chunksize, usecols=None, dtype=None):
+        """Read the `name` table of the given service in chunks of `chunksize` rows
+
+        Chunks are not kept by the store, so tables too large to hold in memory
+        (e.g. stop_times.txt) can be processed with bounded memory.
+
+        Params:
+            service (str): name of the service folder, e.g. "bx_bus" or "LIRR"
+            name (str): file name of the GTFS table, e.g. "stop_times.txt"
+            chunksize (int): number of rows per chunk
+            usecols (list, optional): columns to read
+            dtype (dict, optional): dtypes overriding the ones used for the table
+        Returns:
+            chunks: iterator of DataFrames
+        """
+        dtypes = dict(table_dtypes.get(name, {}))
+        dtypes.update(dtype or {})
+        if usecols is not None:
+            dtypes = {k: v for k, v in dtypes.items() if k in usecols}
+        with self.open_table(service, name) as f:
+            yield from pd.read_csv(
+                f, usecols=usecols, dtype=dtypes or None, chunksize=chunksize
+            )
+
+    def counties(self):
+        """Return the counties boundary layer reprojected to NY State Plane (ft)
+
+        The layer set with preload_counties for this store's path is used when there is one.
+        """
+        if self._counties is None:
+            if self.path in _preloaded_counties:
+                self._counties = _preloaded_counties[self.path]
+            else:
+                # imported here, reading GTFS tables doesn't need the geospatial libraries
+                import geopandas as gpd
+                from pyproj import CRS
+
+                counties = gpd.read_file(os.path.join(self.path, "counties_bndry.geojson"))
+                self._counties = counties.to_crs(CRS.from_epsg(2263))
+        return self._counties
+
+    def county_lookup(self):
+        """Return a CountyLookup over the counties layer, built on first use"""
+        if self._county_lookup is None:
+            from county_lookup import CountyLookup
+
+            self._county_lookup = CountyLookup(self.counties())
+        return self._county_lookup
+
+    def route_catalog(self, service):
+        """Return the RouteCatalog of a service, built from its routes.txt and trips.txt on first use"""
+        if service not in self._route_catalogs:
+            trips = self.table(service, "trips.txt") if self.has_table(service, "trips.txt") else None
+            self._route_catalogs[service] = RouteCatalog(
+                self.table(service, "routes.txt"), trips, service
+            )
+        return self._route_catalogs[service]
+
+    def evict(self, service=None, name=None):
+        """Drop cached tables so their memory can be released
+
+        Params:
+            service (str, optional): only evict tables of this service
+            name (str, optional): only evict tables with this file name
+        With no arguments every table, the counties layer and its lookup are evicted.
+        Route catalogs are evicted with their service.
+        """
+        for key in list(self._tables):
+            if (service is None or key[0] == service) and (name is None or key[1] == name):
+                del self._tables[key]
+        if name is None:
+            for key in list(self._route_catalogs):
+                if service is None or key == service:
+                    del self._route_catalogs[key]
+        if service is None and name is None:
+            self._counties = None
+            self._county_lookup = None
+
+
+# FeedStores of the current process, see shared_store
+_shared_stores = {}
+
+# counties layers by path, see preload_counties
+_preloaded_counties = {}
+
+
+def preload_counties(path, counties):
+    """Share a counties layer, already reprojected to NY State Plane, with every
+    FeedStore of `path` in this process
+
+    Lets a run over several month folders read and reproject the layer once.
+    Pass None to drop it.
+    """
+    if counties is None:
+        _preloaded_counties.pop(path, None)
+    else:
+        _preloaded_counties[path] = counties
+
+
+def shared_store(path, folder):
+    """Return this process's FeedStore for the given folder, creating it on first use
+
+    Lets jobs that run one after another in the same worker process share parsed
+    tables without passing the store between processes. Only the store of the
+    last folder asked for is kept: a worker moving on to another month folder
+    releases the tables of the previous one.
+    """
+    key = (path, folder)
+    if key not in _shared_stores:
+        for store in _shared_stores.values():
+            store.evict()
+        _shared_stores.clear()
+        _shared_stores[key] = FeedStore(path, folder)
+    return _shared_stores[key]
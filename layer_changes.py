@@ -0,0 +1,397 @@
+"""
+Detects geometry changes between the output layers of two monthly releases.
+
+Features of a layer are matched by ID (route_dir for bus routes, route_id for
+rail routes, stop_id for stops) and the displacement of each matched feature is
+measured in bulk: the Hausdorff distance between the two geometries, which for
+stops is the distance the stop moved. Features whose ID appears in one release
+only are paired by location through an STRtree over the other release's
+unmatched features, so a stop or route that only changed ID isn't reported as
+removed and added. Features sharing an ID within a release (e.g. a stop served
+by two bus services) are compared as one multi-part feature. Layers without an
+ID (subway entrances) are matched by location only.
+
+Distances are in the units of the layers' coordinate system, feet for the NY
+State Plane outputs.
+
+usage: python layer_changes.py <old folder> <new folder> [--tolerance FT] [--radius FT]
+"""
+
+import os
+import re
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyogrio
+import shapely
+
+import layer_writers
+
+# configure logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# layer (name without the month suffix) -> ID column, None to match by location only
+layer_keys = {
+    "routes_LIRR": "route_id",
+    "routes_metro_north": "route_id",
+    "routes_nyc_subway": "route_id",
+    "bus_routes_nyc": "route_dir",
+    "express_bus_routes_nyc": "route_dir",
+    "stops_LIRR": "stop_id",
+    "stops_metro_north": "stop_id",
+    "stops_nyc_subway": "stop_id",
+    "metro_north_bx_bus": "stop_id",
+    "bus_stops_nyc": "stop_id",
+    "express_bus_stops_nyc": "stop_id",
+    "subway_entrances": None,
+}
+
+summary_columns = [
+    "layer", "old", "new", "unchanged", "moved", "relabeled", "added", "removed", "max_distance",
+]
+change_columns = ["layer", "change", "id", "old_id", "distance", "geometry"]
+
+
+def find_layer(shapes_dir, layer):
+    """Return (file path, layer name inside the file or None) of a layer of a release
+
+    Layers are named "<layer>_<month><year>", e.g. "stops_LIRR_may2020", and can
+    be in any of the layer_writers output formats. Returns None when not found.
+    """
+    if not os.path.isdir(shapes_dir):
+        return None
+    pattern = re.compile(rf"^{re.escape(layer)}_[a-z]+\d{{4}}$")
+    extensions = [extension for extension, _ in layer_writers.output_formats.values()]
+    for file_name in sorted(os.listdir(shapes_dir)):
+        stem, extension = os.path.splitext(file_name)
+        file_path = os.path.join(shapes_dir, file_name)
+        if extension == ".gpkg":
+            for name in pyogrio.list_layers(file_path)[:, 0]:
+                if pattern.match(name):
+                    return file_path, name
+        elif extension in extensions and pattern.match(stem):
+            return file_path, None
+    return None
+
+
+def read_layer(location):
+    """Read a layer found with find_layer"""
+    file_path, layer = location
+    if file_path.endswith(".parquet"):
+        return gpd.read_parquet(file_path)
+    return gpd.read_file(file_path, layer=layer)
+
+
+def features_by_id(ids, geoms):
+    """Combine the geometries of features sharing an ID
+
+    Params:
+        ids (Index): ID of each feature
+        geoms (array): geometry of each feature
+    Returns:
+        ids, geoms (tuple): the distinct IDs, in order of appearance, and one geometry
+        per ID, the union of its features' geometries when the ID is repeated
+    """
+    codes, uniques = pd.factorize(ids)
+    geoms = np.asarray(geoms, dtype=object)
+    _, first = np.unique(codes, return_index=True)
+    combined = geoms[first]
+    repeated = np.flatnonzero(np.bincount(codes) > 1)
+    if len(repeated):
+        # features of an ID are contiguous once sorted by code
+        order = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[order], np.stack([repeated, repeated + 1]))
+        for code, start, end in zip(repeated, *bounds):
+            combined[code] = shapely.union_all(geoms[order[start:end]])
+    return pd.Index(uniques), combined
+
+
+def pair_by_location(old_geoms, new_geoms, search_radius):
+    """Pair geometries of two releases by proximity
+
+    Every new geometry is paired with the nearest old geometry within
+    `search_radius`; an old geometry is kept only in its closest pair, and the
+    geometries left over (e.g. two entrances at the same spot) are paired again
+    among themselves until no pair is found.
+
+    Returns:
+        old_idx, new_idx (tuple): positions of the paired geometries
+    """
+    old_paired, new_paired = [], []
+    old_left, new_left = np.arange(len(old_geoms)), np.arange(len(new_geoms))
+    while len(old_left) and len(new_left):
+        tree = shapely.STRtree(old_geoms[old_left])
+        (new_idx, old_idx), distances = tree.query_nearest(
+            new_geoms[new_left], max_distance=search_radius, return_distance=True, all_matches=False
+        )
+        if len(distances) == 0:
+            break
+        pairs = pd.DataFrame({"old": old_left[old_idx], "new": new_left[new_idx], "distance": distances})
+        pairs = pairs.sort_values("distance", kind="stable").drop_duplicates("old")
+        old_paired.append(pairs["old"].to_numpy())
+        new_paired.append(pairs["new"].to_numpy())
+        old_left = np.setdiff1d(old_left, old_paired[-1])
+        new_left = np.setdiff1d(new_left, new_paired[-1])
+    if not old_paired:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    return np.concatenate(old_paired), np.concatenate(new_paired)
+
+
+def segments(geometry):
+    """Return the segments of the lines of a geometry, and its points, as an array"""
+    parts = shapely.get_parts(geometry)
+    lines = np.isin(shapely.get_type_id(parts), [1, 2])
+    coords, index = shapely.get_coordinates(parts[lines], return_index=True)
+    consecutive = index[:-1] == index[1:]
+    pairs = np.stack([coords[:-1][consecutive], coords[1:][consecutive]], axis=1)
+    return np.concatenate([shapely.linestrings(pairs), parts[~lines]])
+
+
+def directed_distance(a, b):
+    """Return the largest distance from a vertex of `a` to `b`
+
+    The vertices are looked up in an STRtree over the segments of `b`, instead of
+    against every segment as shapely.hausdorff_distance does.
+    """
+    vertices = shapely.points(shapely.get_coordinates(a))
+    if len(vertices) == 0:
+        return 0.0
+    _, distances = shapely.STRtree(segments(b)).query_nearest(
+        vertices, return_distance=True, all_matches=False
+    )
+    return distances.max()
+
+
+def displacement(old_geoms, new_geoms, tolerance=0.0, indexed_size=10000):
+    """Return the Hausdorff distance between aligned arrays of geometries
+
+    Pairs whose vertices all match within `tolerance` get distance 0 without
+    measuring. Pairs with more than `indexed_size` vertex combinations (long
+    routes) are measured through directed_distance. A geometry that is missing
+    or empty in one release only has an infinite displacement.
+    """
+    distances = np.zeros(len(old_geoms))
+    old_empty = shapely.is_missing(old_geoms) | shapely.is_empty(old_geoms)
+    new_empty = shapely.is_missing(new_geoms) | shapely.is_empty(new_geoms)
+    measure = ~(old_empty | new_empty)
+    measure[measure] = ~shapely.equals_exact(old_geoms[measure], new_geoms[measure], tolerance)
+    size = shapely.get_num_coordinates(old_geoms) * shapely.get_num_coordinates(new_geoms)
+    bulk = measure & (size <= indexed_size)
+    distances[bulk] = shapely.hausdorff_distance(old_geoms[bulk], new_geoms[bulk])
+    for i in np.flatnonzero(measure & (size > indexed_size)):
+        distances[i] = max(
+            directed_distance(old_geoms[i], new_geoms[i]),
+            directed_distance(new_geoms[i], old_geoms[i]),
+        )
+    distances[old_empty != new_empty] = np.inf
+    return distances
+
+
+def compare_layer(old, new, key, tolerance=5.0, search_radius=500.0, layer=""):
+    """Compare a layer between two releases
+
+    Params:
+        old, new (GeoDataFrame): the layer in the older and newer release
+        key (str): ID column, None to match features by location only
+        tolerance (float): Default value 5.0; displacements up to this distance are
+            not reported
+        search_radius (float): Default value 500.0; largest distance between features
+            paired by location
+        layer (str): name of the layer, for the output
+    Returns:
+        changes, counts (tuple): GeoDataFrame with `change_columns`, in the coordinate
+        system of `new`, and a dict with the number of features of each kind of change;
+        with a key, features are counted once per ID
+    """
+    if old.crs is not None and new.crs is not None and old.crs != new.crs:
+        old = old.to_crs(new.crs)
+
+    if key is None:
+        old_ids = pd.Index(np.arange(len(old)).astype(str))
+        new_ids = pd.Index(np.arange(len(new)).astype(str))
+        old_geoms = np.asarray(old.geometry.values, dtype=object)
+        new_geoms = np.asarray(new.geometry.values, dtype=object)
+    else:
+        old_ids, old_geoms = features_by_id(pd.Index(old[key].astype(str)), old.geometry.values)
+        new_ids, new_geoms = features_by_id(pd.Index(new[key].astype(str)), new.geometry.values)
+        for release, df, ids in (("old", old, old_ids), ("new", new, new_ids)):
+            if len(ids) < len(df):
+                logger.info(
+                    f"{layer}: combined {len(df) - len(ids)} features sharing a {key} "
+                    f"in the {release} release"
+                )
+
+    # features matched by ID
+    if key is None:
+        common = pd.Index([])
+    else:
+        common = old_ids.intersection(new_ids)
+    old_pos = old_ids.get_indexer(common)
+    new_pos = new_ids.get_indexer(common)
+    id_distances = displacement(old_geoms[old_pos], new_geoms[new_pos], tolerance)
+    moved = id_distances > tolerance
+
+    # features with an ID in one release only, paired by location
+    old_rest = np.setdiff1d(np.arange(len(old_geoms)), old_pos)
+    new_rest = np.setdiff1d(np.arange(len(new_geoms)), new_pos)
+    old_paired, new_paired = pair_by_location(
+        old_geoms[old_rest], new_geoms[new_rest], search_radius
+    )
+    old_paired, new_paired = old_rest[old_paired], new_rest[new_paired]
+    pair_distances = displacement(old_geoms[old_paired], new_geoms[new_paired], tolerance)
+    if key is None:
+        # without IDs a pair is the same feature, reported when it moved
+        report_pairs = pair_distances > tolerance
+        pair_change = "moved"
+    else:
+        report_pairs = np.ones(len(old_paired), dtype=bool)
+        pair_change = "relabeled"
+    added = np.setdiff1d(new_rest, new_paired)
+    removed = np.setdiff1d(old_rest, old_paired)
+
+    def frame(change, ids, old_id, distance, geometry):
+        return pd.DataFrame(
+            {
+                "layer": layer,
+                "change": change,
+                "id": ids,
+                "old_id": old_id,
+                "distance": distance,
+                "geometry": geometry,
+            }
+        )
+
+    key_ids = key is not None
+    parts = [
+        frame("moved", common[moved], common[moved], id_distances[moved], new_geoms[new_pos[moved]]),
+        frame(
+            pair_change,
+            new_ids[new_paired[report_pairs]] if key_ids else None,
+            old_ids[old_paired[report_pairs]] if key_ids else None,
+            pair_distances[report_pairs],
+            new_geoms[new_paired[report_pairs]],
+        ),
+        frame("added", new_ids[added] if key_ids else None, None, np.nan, new_geoms[added]),
+        frame("removed", None, old_ids[removed] if key_ids else None, np.nan, old_geoms[removed]),
+    ]
+    changes = gpd.GeoDataFrame(
+        pd.concat(parts, ignore_index=True), geometry="geometry", crs=new.crs
+    )
+
+    displacements = np.concatenate([id_distances, pair_distances])
+    finite = displacements[np.isfinite(displacements)]
+    counts = {
+        "old": len(old_geoms),
+        "new": len(new_geoms),
+        "unchanged": int((~moved).sum() + (~report_pairs).sum()),
+        "moved": int(moved.sum() + (report_pairs.sum() if key is None else 0)),
+        "relabeled": int(report_pairs.sum()) if key is not None else 0,
+        "added": len(added),
+        "removed": len(removed),
+        "max_distance": float(finite.max()) if len(finite) else 0.0,
+    }
+    return changes, counts
+
+
+def compare_releases(path, old_folder, new_folder, layers=None, tolerance=5.0, search_radius=500.0):
+    """Compare the output layers of two month folders
+
+    Params:
+        path(str): Path to the directory where the month folders are stored
+        old_folder, new_folder (str): names of the older and newer month folders
+        layers (list, optional): layers to compare, defaults to all of `layer_keys`
+        tolerance, search_radius (float): see compare_layer
+    Returns:
+        changes, summary (tuple): GeoDataFrame of the changed features of all layers
+        and DataFrame with `summary_columns`
+    """
+    old_dir = os.path.join(path, old_folder, "shapes")
+    new_dir = os.path.join(path, new_folder, "shapes")
+    all_changes = []
+    summary = []
+    for layer in layers or list(layer_keys):
+        old_location = find_layer(old_dir, layer)
+        new_location = find_layer(new_dir, layer)
+        if old_location is None or new_location is None:
+            logger.info(f"Skipped {layer}, it isn't in both releases")
+            continue
+        old, new = read_layer(old_location), read_layer(new_location)
+        key = layer_keys[layer]
+        if key is not None and not (key in old.columns and key in new.columns):
+            logger.info(f"{layer} doesn't have {key} in both releases, matching by location")
+            key = None
+        changes, counts = compare_layer(
+            old,
+            new,
+            key,
+            tolerance,
+            search_radius,
+            layer,
+        )
+        all_changes.append(changes)
+        summary.append(dict(layer=layer, **counts))
+    if all_changes:
+        changes = gpd.GeoDataFrame(
+            pd.concat(all_changes, ignore_index=True), geometry="geometry", crs=all_changes[0].crs
+        )
+    else:
+        changes = gpd.GeoDataFrame(columns=change_columns, geometry="geometry")
+    return changes, pd.DataFrame(summary, columns=summary_columns)
+
+
+def write_layer_changes(path, old_folder, new_folder, changes, summary, output_format="shapefile"):
+    """Write the changed features and the summary to the newer release's 'shapes' folder
+
+    Line and point features go into separate layers, changed_routes_<old>_<new>
+    and changed_stops_<old>_<new>, since a shapefile holds one geometry type;
+    the summary goes to changes_<old>_<new>.csv.
+
+    Returns:
+        outputs (list): names of the written outputs
+    """
+    shapes_dir = os.path.join(path, new_folder, "shapes")
+    suffix = f"{old_folder.lower()}_{new_folder.lower()}"
+    outputs = []
+    points = changes.geom_type.isin(["Point", "MultiPoint"]).to_numpy()
+    for name, features in (("changed_routes", changes[~points]), ("changed_stops", changes[points])):
+        if len(features):
+            outputs.append(
+                layer_writers.write_layer(
+                    features, shapes_dir, f"{name}_{suffix}", output_format, package=f"changes_{suffix}"
+                )
+            )
+    summary_name = f"changes_{suffix}.csv"
+    summary.to_csv(os.path.join(shapes_dir, summary_name), index=False)
+    outputs.append(summary_name)
+    return outputs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Report the features that moved between two releases"
+    )
+    parser.add_argument("old_folder")
+    parser.add_argument("new_folder")
+    parser.add_argument("--path", default=os.getcwd(), help="directory of the month folders")
+    parser.add_argument(
+        "--tolerance", type=float, default=5.0, help="smallest reported displacement, in feet"
+    )
+    parser.add_argument(
+        "--radius", type=float, default=500.0, help="search radius to pair features by location, in feet"
+    )
+    parser.add_argument(
+        "--format", choices=list(layer_writers.output_formats), default="shapefile"
+    )
+    args = parser.parse_args()
+
+    changes, summary = compare_releases(
+        args.path, args.old_folder, args.new_folder, tolerance=args.tolerance, search_radius=args.radius
+    )
+    print(summary.to_string(index=False))
+    write_layer_changes(
+        args.path, args.old_folder, args.new_folder, changes, summary, args.format
+    )
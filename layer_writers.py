@@ -0,0 +1,91 @@
+"""
+Writers for the output layers.
+
+Layers are written to the 'shapes' folder of a data folder in one of the
+`output_formats`: a shapefile, FlatGeobuf or GeoParquet file per layer, or a
+single GeoPackage holding every layer of the month. OGR formats are written
+through pyogrio, which hands whole columns to GDAL instead of writing feature
+by feature; GeoParquet is written with pyarrow.
+
+Each writer returns the name the layer is reported under in feature_report.txt:
+the file name, or "<file>:<layer>" for a layer inside a GeoPackage.
+"""
+
+import os
+
+# output format -> (file extension, OGR driver); GeoParquet isn't written through OGR
+output_formats = {
+    "shapefile": (".shp", "ESRI Shapefile"),
+    "gpkg": (".gpkg", "GPKG"),
+    "flatgeobuf": (".fgb", "FlatGeobuf"),
+    "geoparquet": (".parquet", None),
+}
+
+# lock serializing GeoPackage writes across worker processes, see set_write_lock
+_write_lock = None
+
+
+def set_write_lock(lock):
+    """Set the lock held while writing to a GeoPackage
+
+    Every layer of a month goes into the same GeoPackage, which only takes one
+    writer at a time; worker processes share a multiprocessing.Lock set here
+    by the pool initializer.
+    """
+    global _write_lock
+    _write_lock = lock
+
+
+def write_layer(gdf, shapes_dir, layer, output_format="shapefile", package="layers"):
+    """Write a layer in the given output format
+
+    Params:
+        gdf (GeoDataFrame): layer to write
+        shapes_dir (str): folder the output files are written to
+        layer (str): name of the layer, e.g. "stops_LIRR_may2020"
+        output_format (str): Default value "shapefile"; one of `output_formats`
+        package (str): Default value "layers"; name of the GeoPackage file (without
+            extension) the layers are written into, used with output_format="gpkg"
+    Returns:
+        output (str): name of the written output
+    """
+    if output_format not in output_formats:
+        raise ValueError(
+            f"Unknown output format {output_format!r}, expected one of {list(output_formats)}"
+        )
+    extension, driver = output_formats[output_format]
+
+    if output_format == "geoparquet":
+        output = f"{layer}{extension}"
+        gdf.to_parquet(os.path.join(shapes_dir, output), index=False)
+    elif output_format == "gpkg":
+        file_name = f"{package}{extension}"
+        output = f"{file_name}:{layer}"
+        if _write_lock is not None:
+            _write_lock.acquire()
+        try:
+            # replaces the layer when the GeoPackage already has it and keeps the others
+            gdf.to_file(
+                os.path.join(shapes_dir, file_name), layer=layer, driver=driver, engine="pyogrio"
+            )
+        finally:
+            if _write_lock is not None:
+                _write_lock.release()
+    else:
+        output = f"{layer}{extension}"
+        gdf.to_file(os.path.join(shapes_dir, output), driver=driver, engine="pyogrio")
+    return output
+
+
+def output_exists(shapes_dir, output):
+    """Return True if an output returned by write_layer exists in `shapes_dir`"""
+    file_name, _, layer = output.partition(":")
+    file_path = os.path.join(shapes_dir, file_name)
+    if not os.path.exists(file_path):
+        return False
+    if not layer:
+        return True
+    # imported here, so that output_formats can be read without loading GDAL
+    import pyogrio
+
+    return layer in pyogrio.list_layers(file_path)[:, 0]
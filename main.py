@@ -1,27 +1,316 @@
-import os
+"""
+Command line interface of the MTA GTFS layers.
+
+usage: python main.py <command> [options]
+
+commands:
+    download    download the GTFS feeds into a month folder
+    build       create the layers of a month folder, all of them or selected steps
+    all         download, then build (the default when no command is given)
+    diff        compare the feeds, or the output layers, of month folders
+    report      print the feature counts, and stage timings, of a built month folder
 
-from mta_gtfs_data_getter import download_gtfs_data
-from mta_gtfs_shapefiles_maker import (
-    make_bus_routes_shapefiles,
-    make_bus_stops_shapefiles,
-    make_rail_routes_shapefiles,
-    make_rail_stops_shapefiles,
-    make_subway_entrances_shapefiles,
-)
+Each command imports the libraries it needs when it runs, so `download` and
+`report` start without loading pandas or the geospatial libraries.
+"""
+
+import os
+import sys
+import argparse
 
 from datetime import datetime
 
+from layer_writers import output_formats
+
 path_name = os.getcwd()
 # folder = "July2019"
 folder = datetime.today().strftime("%b%Y")
 
-rails = ["LIRR", "metro_north", "nyc_subway"]
+# see build_manifest.manifest_name
+manifest_name = "build_manifest.json"
+
+
+def download(args):
+    """Download the feeds into the month folder"""
+    from mta_gtfs_data_getter import download_gtfs_data
+
+    download_gtfs_data(
+        args.path,
+        args.folder,
+        previous_folder_name=args.previous_folder,
+        extract=not args.no_extract,
+    )
+
+
+def build(args):
+    """Build the layers of the month folder, or only the selected steps"""
+    from build_manifest import BuildManifest
+    from gtfs_feed_store import shared_store
+    from reference_data import pin_snapshot
+    from pipeline_scheduler import pipeline_jobs, run_jobs
+    from batch_builder import month_year
+    import mta_gtfs_shapefiles_maker as maker
+
+    pin_snapshot("Stations.csv", args.stations_csv)
+    pin_snapshot("StationEntrances.csv", args.entrances_csv)
+    try:
+        # layers are named after the month of their folder, run_jobs passes it to the workers
+        maker.monthYear = month_year(args.folder)
+    except ValueError:
+        pass
+
+    try:
+        jobs = pipeline_jobs(
+            args.path,
+            args.folder,
+            output_format=args.format,
+            simplify_tolerances=args.simplify,
+            frequencies=args.frequencies,
+            steps=args.steps,
+        )
+    except ValueError as e:
+        # unknown steps
+        sys.exit(str(e))
+    manifest = BuildManifest(
+        args.path, args.folder, shared_store(args.path, args.folder), force=args.force
+    )
+    timings = run_jobs(
+        args.path,
+        args.folder,
+        jobs,
+        workers=args.workers,
+        manifest=manifest,
+        profile=args.profile or args.profile_memory,
+        trace_memory=args.profile_memory,
+    )
+    print(f"Built {len(timings)} jobs in {sum(timings.values()):.1f}s of job time")
+
+
+def download_and_build(args):
+    download(args)
+    build(args)
+
+
+def diff(args):
+    """Compare each month folder with the previous one"""
+    if len(args.folders) < 2:
+        sys.exit("Give at least two month folders")
+
+    if args.layers:
+        from layer_changes import compare_releases, write_layer_changes
+
+        for old_folder, new_folder in zip(args.folders, args.folders[1:]):
+            changes, summary = compare_releases(args.path, old_folder, new_folder)
+            print(summary.to_string(index=False))
+            write_layer_changes(args.path, old_folder, new_folder, changes, summary, args.format)
+        return
+
+    import pandas as pd
+    from gtfs_feed_diff import diff_series, write_diff_report
+
+    summary, changes = diff_series(args.path, args.folders)
+    with pd.option_context("display.max_rows", None, "display.width", 120):
+        print(summary.to_string(index=False))
+    if args.output:
+        write_diff_report(summary, changes, args.output)
+
+
+def report(args):
+    """Print the outputs and feature counts recorded in the build manifest of the folder"""
+    import json
+
+    manifest_path = os.path.join(args.path, args.folder, manifest_name)
+    if not os.path.exists(manifest_path):
+        sys.exit(f"{args.folder} has no {manifest_name}, build it first")
+    with open(manifest_path) as f:
+        steps = json.load(f).get("steps", {})
+
+    rows = []
+    for step, entry in steps.items():
+        # report lines look like "Feature count for <output> = <count>"
+        for line in entry["report"]:
+            output, _, count = line.split("Feature count for ", 1)[1].rpartition(" = ")
+            rows.append((step, output, count.strip()))
+    print_table(["step", "output", "features"], rows)
+
+    if args.stages:
+        stages_path = os.path.join(args.path, args.folder, "stage_report.json")
+        if not os.path.exists(stages_path):
+            sys.exit(f"{args.folder} has no stage_report.json, build it with --profile")
+        with open(stages_path) as f:
+            records = json.load(f)
+        seconds = {}
+        for record in records:
+            key = (record.get("job", ""), record["stage"])
+            seconds[key] = seconds.get(key, 0.0) + record["seconds"]
+        slowest = sorted(seconds.items(), key=lambda item: -item[1])[: args.stages]
+        print()
+        print_table(
+            ["job", "stage", "seconds"],
+            [(job, stage, f"{total:.2f}") for (job, stage), total in slowest],
+        )
+
+
+def print_table(columns, rows):
+    """Print rows of strings as left aligned columns"""
+    widths = [max(len(str(value)) for value in column) for column in zip(columns, *rows)]
+    for row in [columns] + list(rows):
+        print("  ".join(str(value).ljust(width) for value, width in zip(row, widths)).rstrip())
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description="Download the MTA GTFS feeds and create the shapefiles"
+    )
+    commands = parser.add_subparsers(dest="command", metavar="command")
+
+    # options shared by the commands working on a month folder
+    folder_options = argparse.ArgumentParser(add_help=False)
+    folder_options.add_argument(
+        "--folder", default=folder, help=f"month folder (default: {folder})"
+    )
+    folder_options.add_argument(
+        "--path", default=path_name, help="directory of the month folders"
+    )
+
+    download_options = argparse.ArgumentParser(add_help=False)
+    download_options.add_argument(
+        "--previous-folder",
+        help="folder of the previous download; feeds that haven't changed are copied from it",
+    )
+    download_options.add_argument(
+        "--no-extract",
+        action="store_true",
+        help="keep the feeds zipped; tables are read straight from the zips",
+    )
+
+    build_options = argparse.ArgumentParser(add_help=False)
+    build_options.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of worker processes used to build the layers (default: number of CPUs)",
+    )
+    build_options.add_argument(
+        "--force",
+        action="store_true",
+        help="rebuild every layer, even those whose inputs haven't changed",
+    )
+    build_options.add_argument(
+        "--format",
+        choices=list(output_formats),
+        default="shapefile",
+        help="format of the output layers; gpkg writes every layer into one GeoPackage",
+    )
+    build_options.add_argument(
+        "--simplify",
+        type=float,
+        nargs="+",
+        default=[],
+        metavar="FEET",
+        help="also write route layers simplified at these tolerances, in feet",
+    )
+    build_options.add_argument(
+        "--frequencies",
+        action="store_true",
+        help="add the average trips per day and hour band to the bus and subway stops",
+    )
+    build_options.add_argument(
+        "--stations-csv",
+        metavar="FILE",
+        help="read Stations.csv from this file instead of the MTA site",
+    )
+    build_options.add_argument(
+        "--entrances-csv",
+        metavar="FILE",
+        help="read StationEntrances.csv from this file instead of the MTA site, "
+        "e.g. the copy archived in a month folder",
+    )
+    build_options.add_argument(
+        "--profile",
+        action="store_true",
+        help="record the time and row counts of each stage in stage_report.json/.csv",
+    )
+    build_options.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="with --profile, also record the peak memory of each stage (slower)",
+    )
+
+    command = commands.add_parser(
+        "download",
+        parents=[folder_options, download_options],
+        help="download the GTFS feeds into a month folder",
+    )
+    command.set_defaults(run=download)
+
+    command = commands.add_parser(
+        "build",
+        parents=[folder_options, build_options],
+        help="create the layers of a month folder",
+    )
+    command.add_argument(
+        "steps",
+        nargs="*",
+        metavar="step",
+        help="steps to build, as names or glob patterns, e.g. routes_nyc_subway or '*_LIRR' "
+        "(default: every step)",
+    )
+    command.set_defaults(run=build)
+
+    command = commands.add_parser(
+        "all",
+        parents=[folder_options, download_options, build_options],
+        help="download the feeds, then create every layer",
+    )
+    command.set_defaults(run=download_and_build, steps=None)
+
+    command = commands.add_parser(
+        "diff", help="compare the feeds, or the output layers, of month folders"
+    )
+    command.add_argument("folders", nargs="+", help="month folders, oldest first")
+    command.add_argument("--path", default=path_name, help="directory of the month folders")
+    command.add_argument(
+        "--layers",
+        action="store_true",
+        help="compare the output layers instead of the feeds (see layer_changes)",
+    )
+    command.add_argument(
+        "--format",
+        choices=list(output_formats),
+        default="shapefile",
+        help="with --layers, format of the written change layers",
+    )
+    command.add_argument("--output", help="write the feed diff CSVs to this directory")
+    command.set_defaults(run=diff)
+
+    command = commands.add_parser(
+        "report",
+        parents=[folder_options],
+        help="print the feature counts of a built month folder",
+    )
+    command.add_argument(
+        "--stages",
+        type=int,
+        nargs="?",
+        const=20,
+        metavar="N",
+        help="also print the N slowest stages of the last profiled build (default: 20)",
+    )
+    command.set_defaults(run=report)
+    return parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # without a command, download and build as before the commands were added
+    if not argv or (argv[0].startswith("-") and argv[0] not in ("-h", "--help")):
+        argv = ["all"] + argv
+    args = make_parser().parse_args(argv)
+    if getattr(args, "steps", None) == []:
+        args.steps = None
+    args.run(args)
+
 
-download_gtfs_data(folder)
-for rail in rails:
-    make_rail_routes_shapefiles(path=path_name, folder=folder, rail=rail)
-    make_rail_stops_shapefiles(path=path_name, folder=folder, rail=rail)
-    
-make_bus_routes_shapefiles(path=path_name, folder=folder)
-make_bus_stops_shapefiles(path=path_name, folder=folder)
-make_subway_entrances_shapefiles(path=path_name, folder=folder)
+if __name__ == "__main__":
+    main()
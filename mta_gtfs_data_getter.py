@@ -7,11 +7,14 @@ last updated on : june 3, 2024
 
 """
 
-import urllib
+import urllib.parse
 from bs4 import BeautifulSoup
 import requests, os
 import zipfile
 import logging
+import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 # configure logger
 logger = logging.getLogger(__name__)
@@ -28,16 +31,78 @@ logger.addHandler(handler)
 # opener = urllib.request.build_opener(proxy_support)
 # urllib.request.install_opener(opener)
 
-def download_gtfs_data(new_folder_name):
+def fetch_feed(session, url, destination, etag=None, last_modified=None, chunk_size=1 << 20):
+    """Download a feed to `destination` unless it is unchanged on the server.
+
+    The request carries If-None-Match/If-Modified-Since headers when `etag`/`last_modified`
+    are given; the body is streamed to disk in chunks of `chunk_size` bytes.
+
+    params:
+        session (requests.Session): session used for the request
+        url (str): url of the feed zip
+        destination (str): path where the zip is saved
+        etag, last_modified (str, optional): validators saved from the previous download
+    returns:
+        changed, etag, last_modified (tuple): False if the server replied 304 Not Modified
+        (nothing is written), and the validators to keep for the next download
+    """
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    with session.get(url, headers=headers, stream=True, timeout=60) as r:
+        if r.status_code == 304:
+            return False, etag, last_modified
+        r.raise_for_status()
+        with open(destination + ".part", "wb") as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+        os.replace(destination + ".part", destination)
+        return True, r.headers.get("ETag"), r.headers.get("Last-Modified")
+
+
+def make_session(pool_size=10):
+    """Return a requests session keeping up to `pool_size` connections per host open"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # session.proxies.update(proxies_dic)
+    return session
+
+
+def download_gtfs_data(
+    path,
+    new_folder_name,
+    previous_folder_name=None,
+    developers_url="https://new.mta.info/developers",
+    session=None,
+    workers=9,
+    extract=True,
+):
     """Downloads GTFS data feeds and places them into corresponding folders. The dates of the MTA
     updates are written into updates.txt file.
+
+    Feeds are downloaded concurrently. The ETag/Last-Modified of every feed is saved in
+    feeds.json in the new folder; when `previous_folder_name` is given, its feeds.json is
+    used to make conditional requests and a feed the server reports as unchanged is
+    copied from the previous folder instead of being downloaded.
     
     params:
+        path (str): Path to the directory where the month folders are stored
         new_folder_name (str): Name of the folder where downloaded data will be stored
+        previous_folder_name (str, optional): Name of the folder of the previous download
+        developers_url (str): Page listing the feeds; links on it may be relative,
+            so a local server with an index page and the zips can stand in for the MTA site
+        session (requests.Session, optional): session used for all requests
+        workers (int): Default value 9; number of feeds downloaded at the same time
+        extract (bool): Default value True; extract the feed zips. The shapefile builders
+            can read the tables straight from the zips, so extraction is optional.
     """
     try:
-        # server_path=r'\\DFSN1V-B\Shares\LibShare\Shared\Divisions\Graduate\GEODATA\MASS_Transit'
-        server_path = os.getcwd()
+        # path=r'\\DFSN1V-B\Shares\LibShare\Shared\Divisions\Graduate\GEODATA\MASS_Transit'
         base_path = "http://web.mta.info/developers"
 
         folders_to_create = [
@@ -66,13 +131,13 @@ def download_gtfs_data(new_folder_name):
         }
 
         for folder in folders_to_create:
-            if not os.path.exists(os.path.join(server_path, new_folder_name, folder)):
-                os.makedirs(os.path.join(server_path, new_folder_name, folder))
+            if not os.path.exists(os.path.join(path, new_folder_name, folder)):
+                os.makedirs(os.path.join(path, new_folder_name, folder))
 
-        url = "https://new.mta.info/developers"
-        r = requests.get(url, 
-                         # proxies=proxies_dic
-                        )
+        if session is None:
+            session = make_session(pool_size=workers)
+
+        r = session.get(developers_url, timeout=60)
         data = r.text
         soup = BeautifulSoup(data, features="lxml")
 
@@ -105,31 +170,64 @@ def download_gtfs_data(new_folder_name):
         dates = [v for v in updates.values()]
         dates_fromatted = [" ".join(d.split()) for d in dates]
 
+        # validators of the previous download, used for conditional requests
+        previous_feeds = {}
+        if previous_folder_name:
+            previous_feeds_path = os.path.join(path, previous_folder_name, "feeds.json")
+            if os.path.exists(previous_feeds_path):
+                with open(previous_feeds_path) as f:
+                    previous_feeds = json.load(f)
+
+        def get_feed(url, folder):
+            name = "{}.zip".format(folder)
+            destination = os.path.join(path, new_folder_name, folder, name)
+            previous = previous_feeds.get(folder, {})
+            previous_zip = os.path.join(path, str(previous_folder_name), folder, name)
+            # only ask for an unchanged reply if there is a zip to reuse
+            can_reuse = previous.get("url") == url and os.path.exists(previous_zip)
+            changed, etag, last_modified = fetch_feed(
+                session,
+                url,
+                destination,
+                etag=previous.get("etag") if can_reuse else None,
+                last_modified=previous.get("last_modified") if can_reuse else None,
+            )
+            if not changed:
+                shutil.copyfile(previous_zip, destination)
+                logger.info(f"{folder} unchanged since {previous_folder_name}, reused its feed")
+            if extract:
+                with zipfile.ZipFile(destination, "r") as zip_ref:
+                    zip_ref.extractall(os.path.join(path, new_folder_name, folder))
+            return {"url": url, "etag": etag, "last_modified": last_modified, "changed": changed}
+
         print("Downloading the data.............")
         # download and unzip the data into its appropriate folders
-        for k, v in gtfs_d.items():
-            if v in folders_match:
-                name = "{}.zip".format(folders_match[v])
-                urllib.request.urlretrieve(
-                    f"{k}",
-                    os.path.join(server_path, new_folder_name, folders_match[v], name),
-                )
-                zip_ref = zipfile.ZipFile(
-                    os.path.join(server_path, new_folder_name, folders_match[v], name), "r"
+        feeds = {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                folders_match[v]: pool.submit(
+                    get_feed, urllib.parse.urljoin(developers_url, k), folders_match[v]
                 )
-                zip_ref.extractall(
-                    os.path.join(server_path, new_folder_name, folders_match[v])
-                )
-                zip_ref.close()
+                for k, v in gtfs_d.items()
+                if v in folders_match
+            }
+            for folder, future in futures.items():
+                feeds[folder] = future.result()
+
+        with open(os.path.join(path, new_folder_name, "feeds.json"), "w") as f:
+            json.dump(feeds, f, indent=2)
 
         # write out the dates of the latest update by MTA for each data downloaded
-        with open(os.path.join(server_path, new_folder_name, "updates.txt"), "w") as t:
+        with open(os.path.join(path, new_folder_name, "updates.txt"), "w") as t:
             for line in dates_fromatted:
                 t.write(line + "\n")
 
         print("Done!", "Check the", new_folder_name, "folder")
-        logger.info(f"Downloaded GTFS data from {base_path}")
+        reused = [folder for folder, feed in feeds.items() if not feed["changed"]]
+        logger.info(
+            f"Downloaded GTFS data from {base_path}, {len(reused)} unchanged feeds reused: {reused}"
+        )
 
     except Exception as e:
         logger.exception("Unexpected exception occurred")
-        raise ("Unexpected exception occurred", e)
+        raise
@@ -1,11 +1,21 @@
 import geopandas as gpd
 import pandas as pd
+import numpy as np
 import os
-from shapely.geometry import Point, LineString
+import shapely
 # from fiona.crs import from_epsg
-from pyproj import CRS
+from pyproj import CRS, Transformer
 import logging
 import datetime
+from functools import lru_cache
+from contextlib import contextmanager
+
+from gtfs_feed_store import FeedStore
+from county_lookup import sjoin_counties
+from stage_profiler import profile_stage, profiled
+from service_frequency import frequency_counter, frequency_columns, stop_frequencies
+from reference_data import read_reference
+import layer_writers
 
 # configure logger
 logger = logging.getLogger(__name__)
@@ -49,35 +59,6 @@ subway_segments_to_remove = [
     "5..S21R",
 ]
 
-# this is to add a 'group' column to use for MTA's subway map-like coloring of the routes
-d = {
-    "FS": "S",
-    "GS": "S",
-    "1": "123",
-    "3": "123",
-    "2": "123",
-    "5": "456",
-    "4": "456",
-    "7": "7",
-    "6": "456",
-    "A": "ACE",
-    "C": "ACE",
-    "E": "ACE",
-    "B": "BDFM",
-    "D": "BDFM",
-    "G": "G",
-    "F": "BDFM",
-    "H": "S",
-    "J": "JZ",
-    "M": "BDFM",
-    "L": "L",
-    "N": "NQRW",
-    "Q": "NQRW",
-    "R": "NQRW",
-    "SI": "SIR",
-    "W": "NQRW",
-}
-
 # list of old and non-passanger stations
 # Stations S10 and S12 on the SIR no longer exist, they were demolished. 
 # Station 140 South Ferry Loop is a non-passenger station, 
@@ -86,26 +67,15 @@ d = {
 # (the actual station is H04 Broad Channel)
 non_existent_stops=['140', 'H19', 'S10', 'S12']
 
+# bus services (folder names), in the order their data is combined into the bus layers
+bus_services = ["mn_bus", "si_bus", "qn_bus", "bx_bus", "bk_bus", "bus_company"]
 
-# create a dataframe from group dictionary
-route_groups = pd.DataFrame(
-    [[key, value] for key, value in d.items()], columns=["route_id", "group"]
-)
 
-# read-in file that indicates which trains stop at which stations
-trains_at_stops = pd.read_csv(
-    "http://web.mta.info/developers/data/nyct/subway/Stations.csv",
-    usecols=["GTFS Stop ID", "Daytime Routes", "Structure"],
-)
+# feature report lines collected by buffered_feature_report blocks, innermost last
+report_buffers = []
 
-trains_at_stops.rename(
-    columns={
-        "GTFS Stop ID": "stop_id",
-        "Daytime Routes": "trains",
-        "Structure": "structure",
-    },
-    inplace=True,
-)
+# number of stop_times.txt rows read at a time when the table is streamed
+stop_times_chunksize = 500000
 
 # monthYear is appended to all shapefiles names
 today = datetime.datetime.today()
@@ -114,52 +84,195 @@ year = today.year
 monthYear = f"{month}{year}"
 
 
-def pre_process_stops(path, folder, bus_service):
+def distinct_pairs(left, right):
+    """Return the distinct pairs of values found in two aligned Series
+
+    Both Series are factorized to integer codes and the pairs are deduplicated
+    as single int64 keys, so no Python-level work is done per row.
+    Pairs with a missing value on either side are dropped.
+
+    Params:
+        left, right (Series): aligned Series, e.g. stop_id and route_id columns
+    Returns:
+        df: (DataFrame) with one column per Series, named after the Series
+    """
+    left_codes, left_uniques = pd.factorize(left)
+    right_codes, right_uniques = pd.factorize(right)
+    valid = (left_codes >= 0) & (right_codes >= 0)
+    n_right = max(len(right_uniques), 1)
+    keys = np.unique(left_codes[valid].astype(np.int64) * n_right + right_codes[valid])
+    return pd.DataFrame(
+        {
+            left.name: left_uniques.take(keys // n_right),
+            right.name: right_uniques.take(keys % n_right),
+        }
+    )
+
+
+def stream_stop_route_pairs(
+    store, service, stop_id_dtype, chunksize=stop_times_chunksize, frequencies=None
+):
+    """Return the distinct (stop_id, route_id) pairs served by the given service
+
+    stop_times.txt is streamed in chunks of `chunksize` rows keeping only the
+    trip_id and stop_id columns; trips are mapped to routes through an index
+    built from trips.txt and the distinct pairs are accumulated chunk by chunk,
+    so memory stays bounded by the number of pairs rather than the table size.
+    When a `frequencies` counter is given, the stop times are read as well and
+    each chunk is also counted by it, in the same pass over the file.
+
+    Params:
+        store (FeedStore): store the tables are read from
+        service (str): name of the service folder, e.g. "bx_bus"
+        stop_id_dtype: dtype of stop_id in stops.txt, pairs are returned with the same dtype
+        chunksize (int): number of stop_times.txt rows read at a time
+        frequencies (service_frequency.StopFrequencies, optional): counter fed every chunk
+    Returns:
+        df: (DataFrame) with stop_id and route_id columns
+    """
+    trips = store.table(service, "trips.txt")
+    trip_routes = trips.drop_duplicates("trip_id").set_index("trip_id")["route_id"]
+
+    usecols = ["trip_id", "stop_id"]
+    if frequencies is not None:
+        usecols += ["arrival_time", "departure_time"]
+    pairs = pd.DataFrame(columns=["stop_id", "route_id"])
+    for chunk in store.iter_table(
+        service,
+        "stop_times.txt",
+        chunksize,
+        usecols=usecols,
+        dtype={"stop_id": str},
+    ):
+        if frequencies is not None:
+            frequencies.add(chunk)
+        routes = chunk["trip_id"].map(trip_routes).rename("route_id")
+        chunk_pairs = distinct_pairs(chunk["stop_id"], routes)
+        if len(pairs):
+            chunk_pairs = pd.concat([pairs, chunk_pairs], ignore_index=True)
+        pairs = distinct_pairs(chunk_pairs["stop_id"], chunk_pairs["route_id"])
+
+    # stop ids are read as text so every chunk parses them alike;
+    # match them to the type used in stops.txt
+    if pd.api.types.is_numeric_dtype(stop_id_dtype):
+        pairs["stop_id"] = pd.to_numeric(pairs["stop_id"], errors="coerce")
+    return distinct_pairs(pairs["stop_id"], pairs["route_id"])
+
+
+def pre_process_stops(
+    path, folder, bus_service, store=None, chunksize=stop_times_chunksize, frequencies=False
+):
     """Read, join and process stop tables.
     Given three tables produce a single table
-    with routes association for each stop.
+    with routes association for each stop, and whether the route is a local
+    route (see route_catalog).
+
+    Tables are taken from `store` (FeedStore) when given, otherwise read from disk.
+    stop_times.txt is streamed `chunksize` rows at a time (see stream_stop_route_pairs);
+    pass chunksize=None to read it whole.
+    With `frequencies` on, the service frequency columns (see
+    service_frequency.frequency_columns) are added, counted in the same pass.
     
     return example:
     
-    stop_id|stop name                     |lat       |lon       |route_id
-    -------|------------------------------|--------- |----------|--------
-     100048|GRAND CONCOURSE/E 196 ST      |40.867955 |-73.892642|BXM4
-     100058|SEDGWICK AV/VAN CORTLANDT AV W|40.882828 |-73.893138|BXM3
-     100060|SEDGWICK AV/GILES PL          |40.880924 |-73.896698|BXM3
-     100071|HENRY HUDSON PKY E/W 239 ST   |40.889520 |-73.908064|BXM18
-     100071|HENRY HUDSON PKY E/W 239 ST   |40.889520 |-73.908064|BXM1
-     100071|HENRY HUDSON PKY E/W 239 ST   |40.889520 |-73.908064|BXM2
+    stop_id|stop name                     |lat       |lon       |route_id|local
+    -------|------------------------------|--------- |----------|--------|-----
+     100048|GRAND CONCOURSE/E 196 ST      |40.867955 |-73.892642|BXM4    |False
+     100058|SEDGWICK AV/VAN CORTLANDT AV W|40.882828 |-73.893138|BXM3    |False
+     100060|SEDGWICK AV/GILES PL          |40.880924 |-73.896698|BXM3    |False
+     100071|HENRY HUDSON PKY E/W 239 ST   |40.889520 |-73.908064|BXM18   |False
+     100071|HENRY HUDSON PKY E/W 239 ST   |40.889520 |-73.908064|BXM1    |False
+     100071|HENRY HUDSON PKY E/W 239 ST   |40.889520 |-73.908064|BXM2    |False
 
     """
-    stops = pd.read_csv(
-        os.path.join(path, folder, bus_service, "stops.txt"),
-        usecols=["stop_id", "stop_name", "stop_lat", "stop_lon"],
-    )
-    stop_times = pd.read_csv(os.path.join(path, folder, bus_service, "stop_times.txt"))
-    trips = pd.read_csv(os.path.join(path, folder, bus_service, "trips.txt"))
-    df = stop_times.merge(trips, on="trip_id")
-    routes_for_stops = pd.DataFrame(
-        df.groupby("stop_id")["route_id"].agg(lambda x: list(set(x)))
-    ).reset_index()
-    stop_id_route = (
-        routes_for_stops.route_id.apply(pd.Series)
-        .merge(routes_for_stops, left_index=True, right_index=True)
-        .drop(["route_id"], axis=1)
-        .melt(id_vars="stop_id", value_name="route_id")
-        .drop("variable", axis=1)
-        .dropna()
-    )
-    return stops.merge(stop_id_route, on="stop_id")
+    if store is None:
+        store = FeedStore(path, folder)
+    stops = store.table(bus_service, "stops.txt")[
+        ["stop_id", "stop_name", "stop_lat", "stop_lon"]
+    ]
+    counter = frequency_counter(store, bus_service) if frequencies else None
+    with profile_stage("stop_routes", service=bus_service) as stage:
+        if chunksize:
+            df = stream_stop_route_pairs(
+                store,
+                bus_service,
+                stops["stop_id"].dtype,
+                chunksize=chunksize,
+                frequencies=counter,
+            )
+        else:
+            stop_times = store.table(bus_service, "stop_times.txt")
+            trips = store.table(bus_service, "trips.txt")
+            if counter is not None:
+                counter.add(stop_times)
+            df = stop_times.merge(trips, on="trip_id")
+        stop_id_route = stage.output(distinct_pairs(df["stop_id"], df["route_id"]))
+    # local or express, from the route catalog
+    stop_id_route["local"] = store.route_catalog(bus_service).is_local(stop_id_route["route_id"])
+    if counter is not None:
+        stops = add_frequencies(stops, counter.result())
+    with profile_stage("merge", stops, service=bus_service) as stage:
+        return stage.output(stops.merge(stop_id_route, on="stop_id"))
+
+
+def add_frequencies(stops, frequencies):
+    """Join service frequency columns to stops, with 0 for stops without trips"""
+    columns = frequency_columns()
+    stops = stops.merge(frequencies, on="stop_id", how="left")
+    stops[columns] = stops[columns].fillna(0.0)
+    return stops
+
+
+def id_dtype(*columns):
+    """Return a categorical dtype shared by ID columns of several tables
+
+    Categories are the sorted distinct values of all the columns, so tables
+    converted to it are merged on the integer codes and sorting or factorizing
+    the column gives the same order as the original strings.
+    """
+    values = pd.Index(pd.concat([pd.Series(column.unique()) for column in columns]))
+    return pd.CategoricalDtype(values.dropna().unique().sort_values())
+
+
+def narrow_ints(series):
+    """Return an integer column downcast to the smallest integer type holding its values"""
+    if pd.api.types.is_integer_dtype(series.dtype):
+        return pd.to_numeric(series, downcast="integer")
+    return series
+
+
+def expand_dtypes(df):
+    """Convert the compact columns made by read_lines_tables back to their original types
+
+    Categorical columns get the type of their categories and narrowed integer
+    columns become int64, so layers are written with the usual field types.
+    """
+    df = df.copy()
+    for column in df.columns:
+        dtype = df[column].dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype(dtype.categories.dtype)
+        elif pd.api.types.is_integer_dtype(dtype) and dtype.itemsize < 8:
+            df[column] = df[column].astype("int64")
+    return df
 
 
-def read_lines_tables(path, folder, service):
+def read_lines_tables(path, folder, service, store=None, compact=True):
     """Read tables containing route, individual shape (ponts along the route), and trips data
+
+    Tables are taken from `store` (FeedStore) when given, otherwise read from disk.
+
+    With `compact` on, route_id and shape_id are categoricals sharing one dtype
+    across the three tables, so merges between them join on integer codes, and
+    shape_pt_sequence and dir_id are narrowed to the smallest integer type. A few
+    hundred shape ids are otherwise repeated as strings on every shape point.
+    Use expand_dtypes to get the original column types back before writing.
     
     Returns: routes, shapes, trips (tuple): DataFrames for routes, shapes, and trips
     """
-    routes = pd.read_csv(
-        os.path.join(path, folder, f"{service}", "routes.txt"), dtype={"route_id": str}
-    )
+    if store is None:
+        store = FeedStore(path, folder)
+    routes = store.table(service, "routes.txt")
     routes = pd.DataFrame(
         routes,
         columns=["route_id", "route_short_name", "route_long_name", "route_color"],
@@ -174,28 +287,37 @@ def read_lines_tables(path, folder, service):
         inplace=True,
     )
 
-    shapes = pd.read_csv(
-        os.path.join(path, folder, f"{service}", "shapes.txt"),
-        usecols=["shape_id", "shape_pt_lat", "shape_pt_lon", "shape_pt_sequence"],
-        dtype={"shape_id": str},
-    )
-
-    shapes.rename(columns={"shape_pt_lat": "lat", "shape_pt_lon": "lon"}, inplace=True)
+    shapes = store.table(service, "shapes.txt")[
+        ["shape_id", "shape_pt_lat", "shape_pt_lon", "shape_pt_sequence"]
+    ]
 
-    shapes.sort_values(["shape_id", "shape_pt_sequence"], inplace=True)
+    shapes = shapes.rename(columns={"shape_pt_lat": "lat", "shape_pt_lon": "lon"})
 
-    trips = pd.read_csv(
-        os.path.join(path, folder, f"{service}", "trips.txt"),
-        usecols=["route_id", "direction_id", "shape_id"],
-        dtype={"shape_id": str, "route_id": str},
-    )
+    trips = store.table(service, "trips.txt")[["route_id", "direction_id", "shape_id"]]
     trips = trips.rename(columns={"direction_id": "dir_id"}).drop_duplicates()
+
+    if compact:
+        route_ids = id_dtype(routes["route_id"], trips["route_id"])
+        shape_ids = id_dtype(shapes["shape_id"], trips["shape_id"])
+        routes = routes.astype({"route_id": route_ids})
+        shapes = shapes.astype({"shape_id": shape_ids})
+        shapes["shape_pt_sequence"] = narrow_ints(shapes["shape_pt_sequence"])
+        trips = trips.astype({"route_id": route_ids, "shape_id": shape_ids})
+        trips["dir_id"] = narrow_ints(trips["dir_id"])
+
+    # with compact ids this sorts on the category codes, in the same order as the strings
+    shapes = shapes.sort_values(["shape_id", "shape_pt_sequence"])
     return routes, shapes, trips
 
 
+@profiled("geometry")
 def create_line_segments(df, x="lon", y="lat", epsg=4269):
     """Creates a GeodataFrame of line segments from the 
         shapes dataframe (CRS is NAD83)
+
+       One line is built per shape_id from its points in row order. Lines are
+       created in bulk from the coordinate arrays, without building a Point
+       object for each vertex.
         
        Params:
             df (DataFrame): pandas DataFrame 
@@ -207,43 +329,186 @@ def create_line_segments(df, x="lon", y="lat", epsg=4269):
     """
 
     if df[x].isna().sum() > 0 or df[y].isna().sum() > 0:
-        raise f"DataFrame contains Null coordinates; consider removing rows with Null {x,y} values"
-
-    points = [Point(xy) for xy in zip(df[x], df[y])]
-    gdf = gpd.GeoDataFrame(df.copy(), geometry=points)
-    line_segments = (
-        gdf.groupby(["shape_id"])["geometry"]
-        .apply(lambda x: LineString(x.tolist()))
-        .reset_index()
+        raise Exception(f'''DataFrame contains Null coordinates; 
+                        consider removing rows with Null {x,y} values''')
+
+    # integer code of each point's shape, in sorted shape_id order
+    codes, shape_ids = pd.factorize(df["shape_id"], sort=True)
+    has_shape = codes >= 0
+    codes = codes[has_shape]
+    # group the points of each shape together, keeping their order within the shape
+    order = np.argsort(codes, kind="stable")
+    coords = np.column_stack(
+        [df[x].to_numpy()[has_shape], df[y].to_numpy()[has_shape]]
+    )[order]
+    line_segments = pd.DataFrame(
+        {
+            "shape_id": shape_ids,
+            "geometry": shapely.linestrings(coords, indices=codes[order]),
+        }
     )
 
     gdf_out = gpd.GeoDataFrame(line_segments, geometry="geometry", crs=CRS.from_epsg(epsg))
     return gdf_out
 
 
-def create_point_shapes(df, x="stop_lon", y="stop_lat", epsg=4269):
+def dissolve_lines(gdf, by):
+    """Dissolve lines on a column, like GeoDataFrame.dissolve(by=by, as_index=False)
+
+       Trips of a route share a handful of shapes, so the lines of a group are
+       mostly repeats of the same geometry; repeats are dropped by hashing their
+       WKB before the lines are combined. The distinct lines of each group are
+       assembled into a MultiLineString, and only the groups whose lines cross
+       or overlap (the MultiLineString isn't simple) are unioned, which splits
+       and merges their lines where they meet. A simple MultiLineString is
+       already equal to the union of its lines, so the result is equal to that
+       of dissolve without noding every group.
+
+       Params:
+            gdf (GeoDataFrame): line GeoDataFrame
+            by (str): column to dissolve on
+        Returns:
+            gdf: (GeoDataFrame) one row per value of `by`, other columns taken from
+            the first row of the group
+    """
+    geometry = gdf.geometry.name
+    attributes = gdf.drop(columns=geometry).groupby(by, sort=True, dropna=True).first()
+
+    repeated = pd.DataFrame(
+        {by: gdf[by].to_numpy(), "wkb": shapely.to_wkb(gdf.geometry.values)}
+    ).duplicated()
+    lines = gdf.loc[~repeated.to_numpy(), [by, geometry]]
+    lines = lines.loc[lines[by].notna()]
+
+    codes = attributes.index.get_indexer(lines[by])
+    order = np.argsort(codes, kind="stable")
+    parts, index = shapely.get_parts(lines.geometry.values[order], return_index=True)
+    part_codes = codes[order][index]
+    # groups without lines are left missing
+    merged = shapely.multilinestrings(
+        parts, indices=part_codes, out=np.empty(len(attributes), dtype=object)
+    )
+    # parts of a group are contiguous, node only the groups with crossing lines
+    crossing = ~shapely.is_simple(merged) & ~shapely.is_missing(merged)
+    for code in np.flatnonzero(crossing):
+        start, end = np.searchsorted(part_codes, [code, code + 1])
+        merged[code] = shapely.union_all(parts[start:end])
+    dissolved = gpd.GeoDataFrame(
+        {geometry: merged},
+        geometry=geometry,
+        index=attributes.index,
+        crs=gdf.crs,
+    )
+    return dissolved.join(attributes).reset_index()
+
+
+@lru_cache(maxsize=None)
+def get_transformer(from_epsg, to_epsg):
+    """Return a (cached) transformer between two EPSG coordinate systems, in x,y order"""
+    return Transformer.from_crs(
+        CRS.from_epsg(from_epsg), CRS.from_epsg(to_epsg), always_xy=True
+    )
+
+
+@profiled("geometry")
+def create_point_shapes(df, x="stop_lon", y="stop_lat", epsg=4269, to_epsg=None):
     """ Create a point GeodataFrame from DataFrame with x,y coordinates
         in NAD83 coordinate system
+
+        When `to_epsg` is given the x,y arrays are transformed before the points
+        are created, so the GeoDataFrame is returned already in that coordinate
+        system and doesn't need a `to_crs` call.
         
         Params:
             df (DataFrame): pandas DataFrame 
             x, y (str, optional) Default values x="stop_lon", y="stop_lat", 
             column names for x and y coordinates
             epsg (int): Default value epsg=4269; EPSG value for x,y coordinate system
+            to_epsg (int, optional): EPSG value of the output coordinate system
         Returns: 
-            gdf: (GeoDataFrame) Point GeoDataFrame in NAD83 Coordinate System
+            gdf: (GeoDataFrame) Point GeoDataFrame in NAD83 Coordinate System,
+            or in the `to_epsg` Coordinate System when given
     """
     if df[x].isna().sum() > 0 or df[y].isna().sum() > 0:
         raise Exception(f'''DataFrame contains Null coordinates; 
                         consider removing rows with Null {x,y} values''')
 
-    points = [Point(xy) for xy in zip(df[x], df[y])]
-    gdf = gpd.GeoDataFrame(df, geometry=points, crs=CRS.from_epsg(epsg))
+    xs = df[x].to_numpy(dtype=float)
+    ys = df[y].to_numpy(dtype=float)
+    if to_epsg is not None and to_epsg != epsg:
+        xs, ys = get_transformer(epsg, to_epsg).transform(xs, ys)
+        epsg = to_epsg
+    gdf = gpd.GeoDataFrame(df, geometry=shapely.points(xs, ys), crs=CRS.from_epsg(epsg))
     return gdf
 
 
+def write_layer(gdf, path, folder, layer, output_format="shapefile"):
+    """Write a GeoDataFrame to the 'shapes' folder
+
+    Params:
+        gdf (GeoDataFrame): layer to write
+        path(str): Path to the directory where GTFS data is stored
+        folder (str): Name of the folder where the GTFS data is stored
+        layer (str): name of the layer, e.g. "stops_LIRR_may2020"
+        output_format (str): Default value "shapefile"; one of layer_writers.output_formats,
+            with "gpkg" every layer goes into mta_gtfs_<monthYear>.gpkg
+    Returns:
+        output (str): name of the written output, e.g. "stops_LIRR_may2020.shp"
+    """
+    with profile_stage("write", gdf, layer=layer, output_format=output_format):
+        return layer_writers.write_layer(
+            gdf,
+            os.path.join(path, folder, "shapes"),
+            layer,
+            output_format,
+            package=f"mta_gtfs_{monthYear.lower()}",
+        )
+
+
+def write_simplified_layers(gdf, path, folder, layer, tolerances, output_format="shapefile"):
+    """Write generalized copies of a line layer, one per simplification tolerance
+
+    Each copy is named "<layer>_<tolerance>ft", e.g. "bus_routes_nyc_may2020_100ft".
+    The dissolved routes are unions of many two-point pieces, which can't be
+    simplified, so connected pieces are first merged into longer lines; the
+    lines are then simplified with shapely's topology preserving simplifier.
+    Both run over the whole geometry column at once. The layer must be in NY
+    State Plane, so that tolerances are in feet; the full detail layer is
+    written separately.
+
+    Params:
+        gdf (GeoDataFrame): line layer, in EPSG:2263
+        path(str): Path to the directory where GTFS data is stored
+        folder (str): Name of the folder where the GTFS data is stored
+        layer (str): name of the full detail layer
+        tolerances (list): simplification tolerances in feet
+        output_format (str): Default value "shapefile"; one of layer_writers.output_formats
+    """
+    if len(tolerances):
+        merged = shapely.line_merge(gdf.geometry.values.to_numpy())
+    for tolerance in tolerances:
+        name = f"{layer}_{tolerance:g}ft".replace(".", "_")
+        with profile_stage("simplify", gdf, layer=name) as stage:
+            simplified = stage.output(
+                gdf.set_geometry(
+                    shapely.simplify(merged, tolerance, preserve_topology=True), crs=gdf.crs
+                )
+            )
+        output = write_layer(simplified, path, folder, name, output_format)
+        write_feature_report(
+            path=path,
+            folder=folder,
+            feature=simplified,
+            feature_name=output,
+        )
+
+
 def write_feature_report(path, folder, feature, feature_name):
     """Write feature count to text file
+
+       Inside a `buffered_feature_report` block the line is collected instead of
+       being appended to the file.
+
        Params:
            path(str): Path to the directory where GTFS data is stored
            folder (str): Name of the folder where the GTFS data is stored
@@ -251,35 +516,73 @@ def write_feature_report(path, folder, feature, feature_name):
            feature_name (str): Output name of the feture
         
     """
+    line = f"Feature count for {feature_name} = {feature.shape[0]}\n"
+    if report_buffers:
+        report_buffers[-1].append(line)
+    else:
+        append_feature_report(path, folder, [line])
+
+
+def append_feature_report(path, folder, lines):
+    """Append already formatted lines to the feature report text file"""
     with open(os.path.join(path, folder, "feature_report.txt"), "a") as report_file:
-        report_file.write(f"Feature count for {feature_name} = {feature.shape[0]}\n")
+        report_file.writelines(lines)
+
 
+@contextmanager
+def buffered_feature_report():
+    """Collect the feature report lines written inside the block instead of writing them.
 
-def make_rail_stops_shapefiles(path, folder, rail):
+    Used to write the report in a fixed order when builders run concurrently.
+    Yields the list the lines are collected into; write them with append_feature_report.
+    """
+    lines = []
+    report_buffers.append(lines)
+    try:
+        yield lines
+    finally:
+        report_buffers.remove(lines)
+
+
+def make_rail_stops_shapefiles(
+    path,
+    folder,
+    rail,
+    store=None,
+    output_format="shapefile",
+    frequencies=False,
+    trains_at_stops=None,
+):
     """ Create stops shapefiles for the given rail service
     
         Params:
             path(str): Path to the directory where GTFS data is stored
             folder (str): Name of the folder where the GTFS data is stored
             rail: (str): name of rail service; one of "LIRR", "metro_north" or "nyc_subway"
+            store (FeedStore, optional): store of parsed tables shared across builders
+            output_format (str): Default value "shapefile"; format of the output layers,
+                one of "shapefile", "gpkg", "flatgeobuf" or "geoparquet"
+            frequencies (bool): Default value False; add the average trips per day type
+                and hour band of each station, from stop_times.txt (see service_frequency)
+            trains_at_stops (DataFrame, optional): nyc_subway only; trains stopping at each
+                station, already read with read_trains_at_stops; read with it when not given
             
         Created shapefiels are stored in the 'shapes' folder in the same directory as 
         as the the input parameters.
     """
     try:
-        counties = gpd.read_file(
-            os.path.join(path, "counties_bndry.geojson"), driver="GeoJSON"
-        )
-        # reproject to NY State Plane
-        counties = counties.to_crs(epsg=2263)
+        if store is None:
+            store = FeedStore(path, folder)
+        # lookup over the counties reprojected to NY State Plane
+        counties = store.county_lookup()
 
-        stops = pd.read_csv(
-            os.path.join(path, folder, f"{rail}", "stops.txt"),
-            usecols=["stop_id", "stop_name", "stop_lat", "stop_lon"],
-        )
+        stops = store.table(rail, "stops.txt")[
+            ["stop_id", "stop_name", "stop_lat", "stop_lon"]
+        ]
 
+        # compared as text, LIRR and Metro-North stop ids are read as numbers
         stops = stops.loc[
-            stops["stop_id"].isin(
+            stops["stop_id"].astype(str).isin(
                 stops.stop_id.astype(str)
                 .str.rstrip("N")
                 .str.rstrip("S")
@@ -300,11 +603,14 @@ def make_rail_stops_shapefiles(path, folder, rail):
         )  # rename the last column; it will be used as stop_id2 to reference the removed duplicates
 
         if rail == "nyc_subway":
-            stops = (
-                stops.merge(trains_at_stops, on="stop_id", how="outer")
-                .drop_duplicates(["stop_lat", "stop_lon"], keep="first")
-                .merge(df, on=["stop_lat", "stop_lon"], how="left")
-            )
+            if trains_at_stops is None:
+                trains_at_stops = read_trains_at_stops(path)
+            with profile_stage("merge", stops, service=rail) as stage:
+                stops = stage.output(
+                    stops.merge(trains_at_stops, on="stop_id", how="outer")
+                    .drop_duplicates(["stop_lat", "stop_lon"], keep="first")
+                    .merge(df, on=["stop_lat", "stop_lon"], how="left")
+                )
             stops=stops.loc[~stops['stop_id'].isin(non_existent_stops), :]
             
         elif rail == "metro_north":
@@ -320,48 +626,43 @@ def make_rail_stops_shapefiles(path, folder, rail):
                 (stops["stop_id"] < 500) | (stops["stop_id"] == 622)
             ].copy()
             stops = stops.drop_duplicates(["stop_lat", "stop_lon"], keep="first")
-            bus_stops_geo = create_point_shapes(metro_north_bus_stops)
-            bus_stops_geo = bus_stops_geo.to_crs(
-                CRS.from_epsg(2263)
-            )  # reproject to NY State Plane (ft)
-            bus_stops_geo = gpd.sjoin(
-                bus_stops_geo, counties, how="inner", predicate="intersects"
-            ).drop("index_right", axis=1)
+            bus_stops_geo = create_point_shapes(
+                metro_north_bus_stops, to_epsg=2263
+            )  # in NY State Plane (ft)
+            bus_stops_geo = sjoin_counties(bus_stops_geo, counties)
             # save shuttle bus GeoDataframe to shapefiles
-            bus_stops_geo.to_file(
-                os.path.join(
-                    path, folder, "shapes", f"{rail}_bx_bus_{monthYear.lower()}.shp"
-                )
+            output = write_layer(
+                bus_stops_geo, path, folder, f"{rail}_bx_bus_{monthYear.lower()}", output_format
             )
             write_feature_report(
                 path=path,
                 folder=folder,
                 feature=bus_stops_geo,
-                feature_name=f"{rail}_bx_bus_{monthYear.lower()}.shp",
+                feature_name=output,
             )
 
         else:
             stops = stops.drop_duplicates(["stop_lat", "stop_lon"], keep="first")
 
-        stops_geo = create_point_shapes(stops)
-        stops_geo = stops_geo.to_crs(
-            CRS.from_epsg(2263)
-        )  # reproject to NY State Plane (ft)
-        stops_geo = gpd.sjoin(stops_geo, counties, how="inner", predicate="intersects").drop(
-            "index_right", axis=1
-        )
+        if frequencies:
+            with profile_stage("frequency", service=rail) as stage:
+                stop_frequency = stage.output(
+                    stop_frequencies(store, rail, chunksize=stop_times_chunksize)
+                )
+            stops = add_frequencies(stops, stop_frequency)
+
+        stops_geo = create_point_shapes(stops, to_epsg=2263)  # in NY State Plane (ft)
+        stops_geo = sjoin_counties(stops_geo, counties)
         # save GeoDataframe to shapefiles
-        stops_geo.to_file(
-            os.path.join(
-                path, folder, "shapes", f"stops_{rail}_{monthYear.lower()}.shp"
-            )
+        output = write_layer(
+            stops_geo, path, folder, f"stops_{rail}_{monthYear.lower()}", output_format
         )
 
         write_feature_report(
             path=path,
             folder=folder,
             feature=stops_geo,
-            feature_name=f"stops_{rail}_{monthYear.lower()}.shp",
+            feature_name=output,
         )
         print(f"Created stop shapefiles for {rail}")
 
@@ -370,20 +671,34 @@ def make_rail_stops_shapefiles(path, folder, rail):
         raise
 
 
-def make_rail_routes_shapefiles(path, folder, rail):
+def make_rail_routes_shapefiles(
+    path,
+    folder,
+    rail,
+    store=None,
+    output_format="shapefile",
+    simplify_tolerances=(),
+):
     """ Create route shapefiles for the given rail service
     
         Params:
             path(str): Path to the directory where GTFS data is stored
             folder (str): Name of the folder where the GTFS data is stored
             rail: (str): name of rail service; one of "LIRR", "metro_north" or "nyc_subway"
+            store (FeedStore, optional): store of parsed tables shared across builders
+            output_format (str): Default value "shapefile"; format of the output layers,
+                one of "shapefile", "gpkg", "flatgeobuf" or "geoparquet"
+            simplify_tolerances (list, optional): tolerances in feet of generalized
+                copies of the route layers, see write_simplified_layers
             
             Created shapefiels are stored in the 'shapes' folder in the same directory as 
             as the the input parameters.
     """
     try:
-        routes, shapes, trips = read_lines_tables(
-            path=path, folder=folder, service=rail
+        if store is None:
+            store = FeedStore(path, folder)
+        _, shapes, trips = read_lines_tables(
+            path=path, folder=folder, service=rail, store=store
         )
         # create new df that doesn't contain unusual service for MTA (applies to subway only)
 
@@ -394,9 +709,12 @@ def make_rail_routes_shapefiles(path, folder, rail):
             # these shape_ids are from the generalized version of the routes
             shapes = shapes.loc[~shapes["shape_id"].isin(["52", "51", "33", "34"])].copy()
 
-        shapes = shapes.merge(
-            trips[["route_id", "shape_id"]], on="shape_id", how="left"
-        ).drop_duplicates()
+        with profile_stage("merge", shapes, service=rail) as stage:
+            shapes = stage.output(
+                shapes.merge(
+                    trips[["route_id", "shape_id"]], on="shape_id", how="left"
+                ).drop_duplicates()
+            )
         
         points_per_shape_id=shapes.groupby('shape_id')['shape_pt_sequence'].count()
         not_enough_for_line=points_per_shape_id.loc[points_per_shape_id<2].index.tolist()
@@ -410,43 +728,48 @@ def make_rail_routes_shapefiles(path, folder, rail):
                 ".", expand=True
             )[0]
         else:
-            line_segments = line_segments.merge(trips, on="shape_id").drop("dir_id", axis=1)
+            with profile_stage("merge", line_segments, service=rail) as stage:
+                line_segments = stage.output(
+                    line_segments.merge(trips, on="shape_id").drop("dir_id", axis=1)
+                )
 
-        lines = line_segments.dissolve(by="route_id", as_index=False)
+        line_segments = expand_dtypes(line_segments)
+        with profile_stage("dissolve", line_segments, service=rail) as stage:
+            lines = stage.output(
+                dissolve_lines(line_segments, "route_id")
+            )
 
-        rail_lines = lines.merge(routes, on="route_id")
+        # names, colors and groups (subway only) from the route catalog,
+        # with the subway color and short name fixes already applied
+        columns = ["route_short", "route_long", "color"]
+        if rail == "nyc_subway":
+            columns.append("group")
+        catalog = store.route_catalog(rail)
+        # only the routes listed in routes.txt are kept
+        lines = lines.loc[catalog.is_listed(lines["route_id"])]
+        rail_lines = lines.join(catalog.attributes(lines["route_id"], columns))
         # reinitialize CRS
         rail_lines.crs=CRS.from_epsg(4269)
 
         if rail == "nyc_subway":
-            rail_lines = rail_lines.merge(
-                route_groups, on="route_id"
-            )  # table join for groups (subway only)
-            # add missing colors for S and SIR lines of the subway
-            rail_lines.loc[rail_lines["route_id"] == "FS", "color"] = "808183"
-            rail_lines.loc[rail_lines["route_id"] == "H", "color"] = "808183"
-            rail_lines.loc[rail_lines["route_id"] == "SI", "color"] = "053159"
-            # and make route_short equal to JZ rather than J
-            rail_lines.loc[rail_lines["route_id"] == "J", "route_short"] = "JZ"
+            # only the routes of a group are kept
+            rail_lines = rail_lines.loc[rail_lines["group"].notna()]
             rail_lines = rail_lines.drop("shape_id", axis=1)
         else:
             rail_lines = rail_lines.drop(["shape_id", "route_short"], axis=1)
-        rail_lines["color"] = "#" + rail_lines["color"]
-        rail_lines = rail_lines.to_crs(epsg=2263)  # reproject to State Plane
+        with profile_stage("reproject", rail_lines, service=rail) as stage:
+            rail_lines = stage.output(rail_lines.to_crs(epsg=2263))  # reproject to State Plane
         # save GeoDataframe to shapefiles
-        rail_lines.to_file(
-            os.path.join(
-                path,
-                folder,
-                "shapes",
-                f"routes_{rail}_{monthYear.lower()}.shp",
-            )
-        )
+        layer = f"routes_{rail}_{monthYear.lower()}"
+        output = write_layer(rail_lines, path, folder, layer, output_format)
         write_feature_report(
             path=path,
             folder=folder,
             feature=rail_lines,
-            feature_name=f"routes_{rail}_{monthYear.lower()}.shp",
+            feature_name=output,
+        )
+        write_simplified_layers(
+            rail_lines, path, folder, layer, simplify_tolerances, output_format
         )
 
         print(f"Created route shapefiles for {rail}")
@@ -455,79 +778,113 @@ def make_rail_routes_shapefiles(path, folder, rail):
         raise
 
 
-def make_bus_stops_shapefiles(path, folder):
+def make_bus_stops_shapefiles(
+    path, folder, store=None, output_format="shapefile", frequencies=False
+):
     """ Create local and express bus stops shapefiles
     
         Params:
             path(str): Path to the directory where GTFS data is stored
             folder (str): Name of the folder where the GTFS data is stored
+            store (FeedStore, optional): store of parsed tables shared across builders
+            output_format (str): Default value "shapefile"; format of the output layers,
+                one of "shapefile", "gpkg", "flatgeobuf" or "geoparquet"
+            frequencies (bool): Default value False; add the average trips per day type
+                and hour band of each stop, from stop_times.txt (see service_frequency)
             
         Created shapefiels are stored in the 'shapes' folder in the same directory as 
         as the the input parameters.
     """
-    bus_services = ["mn_bus", "si_bus", "qn_bus", "bx_bus", "bk_bus", "bus_company"]
     bus_stops = []
     try:
+        if store is None:
+            store = FeedStore(path, folder)
         for bus_service in bus_services:
-            stops = pre_process_stops(path=path, folder=folder, bus_service=bus_service)
+            stops = pre_process_stops(
+                path=path,
+                folder=folder,
+                bus_service=bus_service,
+                store=store,
+                frequencies=frequencies,
+            )
             bus_stops.append(stops)
 
-        all_stops = pd.concat(bus_stops)
-
-        local_stops_mask = all_stops["route_id"].str.match(
-            r"([A-W-Z]\d+|BX\d+)(?!^X\.*?)", na=False
+        write_bus_stops_shapefiles(
+            path, folder, bus_stops, store=store, output_format=output_format
         )
+
+    except Exception as e:
+        logger.exception("Unexpected exception occurred")
+        raise
+
+
+def write_bus_stops_shapefiles(path, folder, bus_stops, store=None, output_format="shapefile"):
+    """ Write local and express bus stops shapefiles from the stops of each bus service
+    
+        Params:
+            path(str): Path to the directory where GTFS data is stored
+            folder (str): Name of the folder where the GTFS data is stored
+            bus_stops (list): DataFrames returned by pre_process_stops, one per bus service
+            store (FeedStore, optional): store of parsed tables shared across builders
+            output_format (str): Default value "shapefile"; format of the output layers,
+                one of "shapefile", "gpkg", "flatgeobuf" or "geoparquet"
+            
+        Created shapefiels are stored in the 'shapes' folder in the same directory as 
+        as the the input parameters.
+    """
+    try:
+        if store is None:
+            store = FeedStore(path, folder)
+        with profile_stage("merge", bus_stops) as stage:
+            all_stops = stage.output(pd.concat(bus_stops))
+
+        # stops of local routes, classified by pre_process_stops
+        local_stops_mask = all_stops["local"].to_numpy(dtype=bool)
         local_stops = all_stops.loc[local_stops_mask].copy()
         express_stops = all_stops.loc[~local_stops_mask].copy()
 
-        local_stop_shapes = create_point_shapes(local_stops)
-        local_stop_shapes = local_stop_shapes.to_crs(CRS.from_epsg(2263))
+        # both in NY State Plane (ft)
+        local_stop_shapes = create_point_shapes(local_stops, to_epsg=2263)
+        express_stop_shapes = create_point_shapes(express_stops, to_epsg=2263)
 
-        express_stop_shapes = create_point_shapes(express_stops)
-        express_stop_shapes = express_stop_shapes.to_crs(CRS.from_epsg(2263))
+        # lookup over the counties reprojected to NY State Plane (ft)
+        counties = store.county_lookup()
 
-        counties = gpd.read_file(
-            os.path.join(path, "counties_bndry.geojson"), driver="GeoJSON"
+        local_stop_shapes = sjoin_counties(local_stop_shapes, counties).drop(
+            ["route_id", "local"], axis=1
         )
 
-        # reproject to NY State Plane (ft)
-        counties = counties.to_crs(CRS.from_epsg(2263))
-
-        local_stop_shapes = gpd.sjoin(
-            local_stop_shapes, counties, how="inner", predicate="intersects"
-        ).drop(["route_id", "index_right"], axis=1)
-
-        express_stop_shapes = gpd.sjoin(
-            express_stop_shapes, counties, how="inner", predicate="intersects"
-        ).drop(["route_id", "index_right"], axis=1)
+        express_stop_shapes = sjoin_counties(express_stop_shapes, counties).drop(
+            ["route_id", "local"], axis=1
+        )
 
         # save GeoDataframes to shapefiles
-        local_stop_shapes.drop_duplicates(
-            subset=["stop_id", "stop_lat", "stop_lon"]
-        ).to_file(
-            os.path.join(
-                path, folder, "shapes", f"bus_stops_nyc_{monthYear.lower()}.shp"
-            )
+        output = write_layer(
+            local_stop_shapes.drop_duplicates(subset=["stop_id", "stop_lat", "stop_lon"]),
+            path,
+            folder,
+            f"bus_stops_nyc_{monthYear.lower()}",
+            output_format,
         )
 
         write_feature_report(
             path=path,
             folder=folder,
             feature=local_stop_shapes,
-            feature_name=f"bus_stops_nyc_{monthYear.lower()}.shp",
+            feature_name=output,
         )
-        express_stop_shapes.drop_duplicates(
-            subset=["stop_id", "stop_lat", "stop_lon"]
-        ).to_file(
-            os.path.join(
-                path, folder, "shapes", f"express_bus_stops_nyc_{monthYear.lower()}.shp"
-            )
+        output = write_layer(
+            express_stop_shapes.drop_duplicates(subset=["stop_id", "stop_lat", "stop_lon"]),
+            path,
+            folder,
+            f"express_bus_stops_nyc_{monthYear.lower()}",
+            output_format,
         )
         write_feature_report(
             path=path,
             folder=folder,
             feature=express_stop_shapes,
-            feature_name=f"express_bus_stops_nyc_{monthYear.lower()}.shp",
+            feature_name=output,
         )
         print(f"Created stop shapefiles for local and express bus stops")
 
@@ -536,67 +893,138 @@ def make_bus_stops_shapefiles(path, folder):
         raise
 
 
-def make_bus_routes_shapefiles(path, folder):
+def make_bus_routes_shapefiles(
+    path,
+    folder,
+    store=None,
+    output_format="shapefile",
+    simplify_tolerances=(),
+):
     """ Create local and express bus routes shapefiles
     
         Params:
             path(str): Path to the directory where GTFS data is stored
             folder (str): Name of the folder where the GTFS data is stored
+            store (FeedStore, optional): store of parsed tables shared across builders
+            output_format (str): Default value "shapefile"; format of the output layers,
+                one of "shapefile", "gpkg", "flatgeobuf" or "geoparquet"
+            simplify_tolerances (list, optional): tolerances in feet of generalized
+                copies of the route layers, see write_simplified_layers
             
         Created shapefiels are stored in the 'shapes' folder in the same directory as 
         as the the input parameters.
     """
-    bus_services = ["mn_bus", "si_bus", "qn_bus", "bx_bus", "bk_bus", "bus_company"]
-    express_services = []
-    local_services = []
     try:
-        for bus_service in bus_services:
-            routes, shapes, trips = read_lines_tables(path, folder, service=bus_service)
+        if store is None:
+            store = FeedStore(path, folder)
+        bus_routes = [
+            process_bus_routes(path, folder, bus_service, store=store)
+            for bus_service in bus_services
+        ]
+
+        write_bus_routes_shapefiles(
+            path,
+            folder,
+            bus_routes,
+            output_format=output_format,
+            simplify_tolerances=simplify_tolerances,
+        )
+
+    except Exception as e:
+        logger.exception("Unexpected exception occurred")
+        raise
+
+
+def process_bus_routes(path, folder, bus_service, store=None):
+    """ Create local and express route lines (NAD83) for a single bus service
+    
+        Params:
+            path(str): Path to the directory where GTFS data is stored
+            folder (str): Name of the folder where the GTFS data is stored
+            bus_service (str): name of the bus service folder, e.g. "bx_bus"
+            store (FeedStore, optional): store of parsed tables shared across builders
+        Returns:
+            local_routes, express_routes (tuple): GeoDataFrames of local and express routes
+    """
+    try:
+        if store is None:
+            store = FeedStore(path, folder)
+        _, shapes, trips = read_lines_tables(
+            path, folder, service=bus_service, store=store
+        )
+        catalog = store.route_catalog(bus_service)
 
+        with profile_stage("merge", shapes, service=bus_service) as stage:
             shapes = shapes.merge(
                 trips[["route_id", "shape_id"]], on="shape_id"
             ).drop_duplicates()
 
-            bus_shapes = shapes.merge(routes, on="route_id")  # table join
+            # shapes of the routes listed in routes.txt
+            bus_shapes = stage.output(shapes.loc[catalog.is_listed(shapes["route_id"])])
 
-            bus_route_shapes = create_point_shapes(bus_shapes, x="lon", y="lat")
+        line_segments = create_line_segments(bus_shapes)
 
-            line_segments = create_line_segments(bus_route_shapes)
-
-            # merge trips and routes to line segments
+        with profile_stage("merge", line_segments, service=bus_service) as stage:
+            # merge trips to line segments
             gdf = line_segments.merge(trips, on="shape_id", how="left")
 
-            gdf = gdf.merge(
-                routes, on="route_id", how="left"
-            )  # table join to get Route associated columns
-
-            # creates new column as concatenation of route_id and direction_id
-            gdf["route_dir"] = gdf.route_id.astype(str).str.cat(
-                gdf.dir_id.astype(str), sep="_"
+            # names and colors from the route catalog, joined on the route codes
+            gdf = stage.output(
+                gdf.join(
+                    catalog.attributes(gdf["route_id"], ["route_short", "route_long", "color"])
+                )
             )
 
-            # dissolves on route_dir to get single line per route
-            route_gdf = gdf.dissolve(by="route_dir", as_index=False)
+        # creates new column as concatenation of route_id and direction_id
+        gdf["route_dir"] = gdf.route_id.astype(str).str.cat(
+            gdf.dir_id.astype(str), sep="_"
+        )
 
-            # reinitialize CRS
-            route_gdf.crs=CRS.from_epsg(4269)
+        gdf = expand_dtypes(gdf)
+        # dissolves on route_dir to get single line per route
+        with profile_stage("dissolve", gdf, service=bus_service) as stage:
+            route_gdf = stage.output(dissolve_lines(gdf, "route_dir"))
 
-            # make hex number for colors
-            route_gdf["color"] = "#" + route_gdf["color"].astype(str)
+        # reinitialize CRS
+        route_gdf.crs=CRS.from_epsg(4269)
 
-            # create a boolean mask with True values for local services
-            local = route_gdf["route_id"].str.match(
-                r"([A-W-Z]\d+|BX\d+)(?!^X\.*?)", na=False
-            )
+        # create a boolean mask with True values for local services
+        local = catalog.is_local(route_gdf["route_id"])
 
-            # apply mask to get local routes
-            local_routes = route_gdf.loc[local].copy()
+        # apply mask to get local routes
+        local_routes = route_gdf.loc[local].copy()
 
-            # apply the inverse of mask to get express routes
-            express_routes = route_gdf.loc[~local].copy()
+        # apply the inverse of mask to get express routes
+        express_routes = route_gdf.loc[~local].copy()
 
-            local_services.append(local_routes)
-            express_services.append(express_routes)
+        return local_routes, express_routes
+
+    except Exception as e:
+        logger.exception("Unexpected exception occurred")
+        raise
+
+
+def write_bus_routes_shapefiles(
+    path, folder, bus_routes, output_format="shapefile", simplify_tolerances=()
+):
+    """ Write local and express bus routes shapefiles from the routes of each bus service
+    
+        Params:
+            path(str): Path to the directory where GTFS data is stored
+            folder (str): Name of the folder where the GTFS data is stored
+            bus_routes (list): (local_routes, express_routes) tuples returned by
+                process_bus_routes, one per bus service
+            output_format (str): Default value "shapefile"; format of the output layers,
+                one of "shapefile", "gpkg", "flatgeobuf" or "geoparquet"
+            simplify_tolerances (list, optional): tolerances in feet of generalized
+                copies of the route layers, see write_simplified_layers
+            
+        Created shapefiels are stored in the 'shapes' folder in the same directory as 
+        as the the input parameters.
+    """
+    try:
+        local_services = [local_routes for local_routes, _ in bus_routes]
+        express_services = [express_routes for _, express_routes in bus_routes]
 
         express_route_gdf = gpd.GeoDataFrame(
             pd.concat(express_services, sort=False),
@@ -626,39 +1054,37 @@ def make_bus_routes_shapefiles(path, folder):
             crs=CRS.from_epsg(4269),
         )
 
-        local_route_gdf = local_route_gdf.to_crs(
-            CRS.from_epsg(2263)
-        )  # reproject to NY State Plane (ft)
-        express_route_gdf = express_route_gdf.to_crs(
-            CRS.from_epsg(2263)
-        )  # reproject to NY State Plane (ft)
+        with profile_stage("reproject", [local_route_gdf, express_route_gdf]):
+            local_route_gdf = local_route_gdf.to_crs(
+                CRS.from_epsg(2263)
+            )  # reproject to NY State Plane (ft)
+            express_route_gdf = express_route_gdf.to_crs(
+                CRS.from_epsg(2263)
+            )  # reproject to NY State Plane (ft)
 
         # save GeoDataframes to shapefiles
-        local_route_gdf.to_file(
-            os.path.join(
-                path, folder, "shapes", f"bus_routes_nyc_{monthYear.lower()}.shp"
-            )
-        )
+        layer = f"bus_routes_nyc_{monthYear.lower()}"
+        output = write_layer(local_route_gdf, path, folder, layer, output_format)
 
         write_feature_report(
             path=path,
             folder=folder,
             feature=local_route_gdf,
-            feature_name=f"bus_routes_nyc_{monthYear.lower()}.shp",
+            feature_name=output,
         )
-        express_route_gdf.to_file(
-            os.path.join(
-                path,
-                folder,
-                "shapes",
-                f"express_bus_routes_nyc_{monthYear.lower()}.shp",
-            )
+        write_simplified_layers(
+            local_route_gdf, path, folder, layer, simplify_tolerances, output_format
         )
+        layer = f"express_bus_routes_nyc_{monthYear.lower()}"
+        output = write_layer(express_route_gdf, path, folder, layer, output_format)
         write_feature_report(
             path=path,
             folder=folder,
             feature=express_route_gdf,
-            feature_name=f"express_bus_routes_nyc_{monthYear.lower()}.shp",
+            feature_name=output,
+        )
+        write_simplified_layers(
+            express_route_gdf, path, folder, layer, simplify_tolerances, output_format
         )
         print(f"Created line shapefiles for local and express bus routes")
 
@@ -667,35 +1093,72 @@ def make_bus_routes_shapefiles(path, folder):
         raise
 
 
-def make_subway_entrances_shapefiles(path, folder):
+def read_trains_at_stops(path=None):
+    """Read which trains stop at which subway stations, from MTA's Stations.csv
+
+    Params:
+        path (str, optional): data directory the table is cached in (see reference_data),
+            defaults to the current directory
+    """
+    trains_at_stops = read_reference(path or os.getcwd(), "Stations.csv")[
+        ["GTFS Stop ID", "Daytime Routes", "Structure"]
+    ]
+    return trains_at_stops.rename(
+        columns={
+            "GTFS Stop ID": "stop_id",
+            "Daytime Routes": "trains",
+            "Structure": "structure",
+        }
+    )
+
+
+def read_station_entrances(path=None):
+    """Read the subway entrances data, from MTA's StationEntrances.csv
+
+    Params:
+        path (str, optional): data directory the table is cached in (see reference_data),
+            defaults to the current directory
+    """
+    return read_reference(path or os.getcwd(), "StationEntrances.csv").copy()
+
+
+def make_subway_entrances_shapefiles(
+    path, folder, store=None, entrances=None, output_format="shapefile", archive=True
+):
     """Create subway entrances shapefiles from csv data
     
-    Data Source is at http://web.mta.info/developers/data/nyct/subway/StationEntrances.csv
+    Data Source is at http://web.mta.info/developers/data/nyct/subway/StationEntrances.csv,
+    cached locally (see reference_data)
         
     Params:
         path(str): Path to the directory where GTFS data is stored
         folder (str): Name of the folder where the GTFS data is stored
+        store (FeedStore, optional): store of parsed tables shared across builders
+        entrances (DataFrame, optional): entrances data already read with
+            read_station_entrances; read with it when not given
+        output_format (str): Default value "shapefile"; format of the output layers,
+            one of "shapefile", "gpkg", "flatgeobuf" or "geoparquet"
+        archive (bool): Default value True; write the entrances data into the folder,
+            False keeps the copy already archived there
             
         Created shapefiels are stored in the 'shapes' folder in the same directory as 
         as the input parameters.
     """
 
     try:
-        # read the entrances data directly from MTA's website
-        entrances = pd.read_csv(
-            "http://web.mta.info/developers/data/nyct/subway/StationEntrances.csv"
-        )
+        if entrances is None:
+            entrances = read_station_entrances(path)
+        else:
+            entrances = entrances.copy()
 
         # write out the entrances data for archivial purposes
-        entrances.to_csv(os.path.join(path, folder, "StationEntrances.csv"))
+        if archive:
+            entrances.to_csv(os.path.join(path, folder, "StationEntrances.csv"))
 
-        # get counties to use in spatial join
-        counties = gpd.read_file(
-            os.path.join(path, "counties_bndry.geojson"), driver="GeoJSON"
-        )
-        counties = counties.to_crs(
-            CRS.from_epsg(2263)
-        )  # reproject counties to NY State Plane
+        # get counties (reprojected to NY State Plane) to use in spatial join
+        if store is None:
+            store = FeedStore(path, folder)
+        counties = store.county_lookup()
 
         # give shorter names to columns
         entrances.columns = [
@@ -734,29 +1197,26 @@ def make_subway_entrances_shapefiles(path, folder):
         # one of the longtitudes is missing negative sign
         # multiply longtitude by -1 where it is positive (in US it will always be negative)
         entrances.update(entrances.loc[entrances["lon"] > 0, "lon"].mul(-1))
-        entrances_shapes = create_point_shapes(entrances, x="lon", y="lat")
-        entrances_shapes = entrances_shapes.to_crs(
-            CRS.from_epsg(2263)
-        )  # reproject to NY State Plane (ft)
-        entrances_shapes = gpd.sjoin(
-            entrances_shapes, counties, how="inner", predicate="intersects"
-        ).drop(
-            "index_right", axis=1
+        entrances_shapes = create_point_shapes(
+            entrances, x="lon", y="lat", to_epsg=2263
+        )  # in NY State Plane (ft)
+        entrances_shapes = sjoin_counties(
+            entrances_shapes, counties
         )  # spatially join entraces to counties layer
-        # change data type of the ADA and free_cross columns -- boolean fields can't be written into shapefile
-        entrances_shapes["ada"] = entrances_shapes["ada"].astype(str)
-        entrances_shapes["free_cross"] = entrances_shapes["free_cross"].astype(str)
-        entrances_shapes.to_file(
-            os.path.join(
-                path, folder, "shapes", f"subway_entrances_{monthYear.lower()}.shp"
-            )
-        )  # write geodataframe to shapefile
+        if output_format == "shapefile":
+            # change data type of the ADA and free_cross columns --
+            # boolean fields can't be written into shapefile
+            entrances_shapes["ada"] = entrances_shapes["ada"].astype(str)
+            entrances_shapes["free_cross"] = entrances_shapes["free_cross"].astype(str)
+        output = write_layer(
+            entrances_shapes, path, folder, f"subway_entrances_{monthYear.lower()}", output_format
+        )  # write geodataframe to the output format
 
         write_feature_report(
             path=path,
             folder=folder,
             feature=entrances_shapes,
-            feature_name=f"subway_entrances_{monthYear.lower()}.shp",
+            feature_name=output,
         )
         print(f"Created subway entrances shapefiles")
 
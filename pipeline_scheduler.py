@@ -0,0 +1,386 @@
+"""
+Runs the shapefile builders of a data folder as a graph of jobs.
+
+Rails, per-borough bus routes and bus stops and the subway entrances are
+independent jobs run across a process pool; the jobs writing the combined bus
+layers depend on the per-borough jobs and run in the parent process, where
+the per-borough results are merged in a fixed order. Feature report lines are
+written in job order, so the report doesn't depend on which job finishes first.
+
+Jobs are grouped into steps, one per layer or group of layers. With a
+BuildManifest, steps whose inputs, code and parameters are unchanged since the
+last build are skipped and their feature report lines are repeated from the manifest.
+
+With profiling on, the stage records of every job (see stage_profiler) are
+collected in the process the job runs in, sent back with its result and
+written to stage_report.json and stage_report.csv in job order.
+"""
+
+import os
+import time
+import fnmatch
+import inspect
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import pandas as pd
+
+from gtfs_feed_store import shared_store
+from stage_profiler import recording, write_stage_report
+import layer_writers
+import mta_gtfs_shapefiles_maker as maker
+
+# configure logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+rails = ["LIRR", "metro_north", "nyc_subway"]
+
+
+class Job:
+    """A single step of the pipeline
+
+    Params:
+        name (str): unique name of the job
+        func (callable): module level function called as func(path, folder, **kwargs);
+            jobs with dependencies also get the list of results of their dependencies, in
+            `deps` order, as the argument after path and folder. Functions with a `store`
+            parameter get the FeedStore of the process they run in.
+        kwargs (dict, optional): extra keyword arguments for func
+        deps (list, optional): names of the jobs that must finish first
+        in_parent (bool): Default value False; run in the parent process rather than the pool
+        step (str, optional): name of the build step the job belongs to, defaults to `name`;
+            the jobs of a step are skipped or run together
+        inputs (list, optional): inputs of the job, as accepted by BuildManifest.fingerprint
+    """
+
+    def __init__(self, name, func, kwargs=None, deps=(), in_parent=False, step=None, inputs=()):
+        self.name = name
+        self.func = func
+        self.kwargs = kwargs or {}
+        self.deps = list(deps)
+        self.in_parent = in_parent
+        self.step = step or name
+        self.inputs = list(inputs)
+
+    def __repr__(self):
+        return f"Job({self.name!r})"
+
+
+def pipeline_jobs(
+    path,
+    folder,
+    output_format="shapefile",
+    simplify_tolerances=(),
+    frequencies=False,
+    entrances=None,
+    trains_at_stops=None,
+    archive_entrances=True,
+    steps=None,
+):
+    """Return the jobs that build every layer of the given folder, or the selected steps
+
+    Params:
+        path(str): Path to the directory where GTFS data is stored
+        folder (str): Name of the folder where the GTFS data is stored
+        output_format (str): Default value "shapefile"; format the layers are written in,
+            one of layer_writers.output_formats
+        simplify_tolerances (list, optional): tolerances in feet of generalized copies
+            of the route layers (see maker.write_simplified_layers)
+        frequencies (bool): Default value False; add service frequency columns to the
+            stop layers (see service_frequency)
+        entrances (DataFrame, optional): subway entrances data already read with
+            maker.read_station_entrances; read with it when not given
+        trains_at_stops (DataFrame, optional): trains stopping at each subway station,
+            already read with maker.read_trains_at_stops; read with it when not given
+        archive_entrances (bool): Default value True; write the entrances data into the
+            folder, False keeps the copy already archived there
+        steps (list, optional): names or glob patterns of the steps to build, e.g.
+            ["routes_nyc_subway"] or ["*_LIRR"], defaults to every step (see `pipeline_steps`)
+    """
+    if steps is not None:
+        unknown = [
+            pattern for pattern in steps if not fnmatch.filter(pipeline_steps(), pattern)
+        ]
+        if unknown:
+            raise ValueError(f"No steps match {unknown}, steps are {pipeline_steps()}")
+
+    def selected(step):
+        return steps is None or any(fnmatch.fnmatch(step, pattern) for pattern in steps)
+
+    counties = "counties_bndry.geojson"
+    line_tables = ["routes.txt", "shapes.txt", "trips.txt"]
+    # tables the service frequency of the stops is computed from
+    frequency_tables = (
+        ["stop_times.txt", "trips.txt", "calendar.txt", "calendar_dates.txt"]
+        if frequencies
+        else []
+    )
+    output = {"output_format": output_format}
+    jobs = []
+    for rail in rails:
+        jobs.append(
+            Job(
+                f"routes_{rail}",
+                maker.make_rail_routes_shapefiles,
+                {
+                    "rail": rail,
+                    "simplify_tolerances": list(simplify_tolerances),
+                    **output,
+                },
+                inputs=[(rail, name) for name in line_tables],
+            )
+        )
+        stops_inputs = [(rail, "stops.txt"), counties]
+        stops_inputs += [(rail, name) for name in frequency_tables]
+        stops_kwargs = {"rail": rail, "frequencies": frequencies, **output}
+        if rail == "nyc_subway" and selected(f"stops_{rail}"):
+            # read once here so that it can be fingerprinted for the build manifest
+            if trains_at_stops is None:
+                trains_at_stops = maker.read_trains_at_stops(path)
+            stops_inputs.append(("Stations.csv", trains_at_stops))
+            stops_kwargs["trains_at_stops"] = trains_at_stops
+        jobs.append(
+            Job(
+                f"stops_{rail}",
+                maker.make_rail_stops_shapefiles,
+                stops_kwargs,
+                inputs=stops_inputs,
+            )
+        )
+
+    for bus_service in maker.bus_services:
+        jobs.append(
+            Job(
+                f"bus_routes_{bus_service}",
+                maker.process_bus_routes,
+                {"bus_service": bus_service},
+                step="bus_routes",
+                inputs=[(bus_service, name) for name in line_tables],
+            )
+        )
+    jobs.append(
+        Job(
+            "bus_routes",
+            maker.write_bus_routes_shapefiles,
+            {"simplify_tolerances": list(simplify_tolerances), **output},
+            deps=[f"bus_routes_{bus_service}" for bus_service in maker.bus_services],
+            in_parent=True,
+        )
+    )
+
+    for bus_service in maker.bus_services:
+        jobs.append(
+            Job(
+                f"bus_stops_{bus_service}",
+                maker.pre_process_stops,
+                {"bus_service": bus_service, "frequencies": frequencies},
+                step="bus_stops",
+                inputs=[
+                    (bus_service, name)
+                    for name in dict.fromkeys(
+                        ["stops.txt", "stop_times.txt", "trips.txt"] + frequency_tables
+                    )
+                ],
+            )
+        )
+    jobs.append(
+        Job(
+            "bus_stops",
+            maker.write_bus_stops_shapefiles,
+            output,
+            deps=[f"bus_stops_{bus_service}" for bus_service in maker.bus_services],
+            in_parent=True,
+            inputs=[counties],
+        )
+    )
+
+    # read once here so that it can be fingerprinted for the build manifest
+    if entrances is None and selected("subway_entrances"):
+        entrances = maker.read_station_entrances(path)
+    jobs.append(
+        Job(
+            "subway_entrances",
+            maker.make_subway_entrances_shapefiles,
+            {"entrances": entrances, "archive": archive_entrances, **output},
+            inputs=[counties, ("StationEntrances.csv", entrances)],
+        )
+    )
+    return [job for job in jobs if selected(job.step)]
+
+
+def pipeline_steps():
+    """Return the names of the steps of the pipeline, in build order"""
+    return (
+        [f"{layer}_{rail}" for rail in rails for layer in ("routes", "stops")]
+        + ["bus_routes", "bus_stops", "subway_entrances"]
+    )
+
+
+def step_params(jobs):
+    """Return the parameters of the jobs of a step, as recorded in the build manifest"""
+    params = {"month": maker.monthYear}
+    for job in jobs:
+        params[job.name] = {
+            k: v for k, v in job.kwargs.items() if not isinstance(v, pd.DataFrame)
+        }
+    return params
+
+
+def run_job(func, path, folder, kwargs, dep_results=None, profile=False, trace_memory=False):
+    """Run one job in the current process
+
+    Returns:
+        result, report_lines, elapsed, stages (tuple): return value of the job, the feature
+        report lines it wrote, its wall time in seconds and its stage records
+        (empty unless `profile` is on)
+    """
+    args = (path, folder) if dep_results is None else (path, folder, dep_results)
+    start = time.perf_counter()
+    if "store" in inspect.signature(func).parameters:
+        kwargs = dict(kwargs, store=shared_store(path, folder))
+    with maker.buffered_feature_report() as report_lines, recording(
+        profile, trace_memory
+    ) as stages:
+        result = func(*args, **kwargs)
+    return result, report_lines, time.perf_counter() - start, stages
+
+
+def init_worker(write_lock, month):
+    """Set up a worker process of run_jobs
+
+    Workers started with spawn or forkserver import the maker afresh, so the
+    GeoPackage write lock and the month the layers are named after are passed
+    from the parent.
+    """
+    layer_writers.set_write_lock(write_lock)
+    maker.monthYear = month
+
+
+def run_jobs(
+    path, folder, jobs, workers=None, manifest=None, profile=False, trace_memory=False
+):
+    """Run jobs in dependency order across a pool of `workers` processes
+
+    Params:
+        path(str): Path to the directory where GTFS data is stored
+        folder (str): Name of the folder where the GTFS data is stored
+        jobs (list): Job objects; the order of the list is the order in which ready
+            jobs are started and feature report lines are written
+        workers (int, optional): number of worker processes, defaults to the number of CPUs;
+            with 1 worker every job runs in the current process
+        manifest (BuildManifest, optional): skip the steps it reports as current and
+            record the steps that are built
+        profile (bool): Default value False; record the stages of each job and write
+            them to stage_report.json and stage_report.csv
+        trace_memory (bool): Default value False; with `profile`, also record the peak
+            memory of each stage with tracemalloc
+    Returns:
+        timings (dict): wall time in seconds of each job that ran, in job order
+    """
+    workers = workers or os.cpu_count()
+    names = [job.name for job in jobs]
+    for job in jobs:
+        missing = [dep for dep in job.deps if dep not in names]
+        if missing:
+            raise ValueError(f"{job.name} depends on unknown jobs {missing}")
+
+    results = {}
+    report_lines = {}
+    timings = {}
+    stages = {}
+    pending = list(jobs)
+    running = {}
+
+    steps = {}
+    for job in jobs:
+        steps.setdefault(job.step, []).append(job)
+    fingerprints = {}
+    if manifest is not None:
+        for step, step_jobs in steps.items():
+            fingerprints[step] = manifest.fingerprint(
+                [item for job in step_jobs for item in job.inputs]
+            )
+            if manifest.is_current(step, fingerprints[step], step_params(step_jobs)):
+                print(f"Skipped {step}, its inputs haven't changed")
+                logger.info(f"Skipped {step}, its inputs haven't changed")
+                for job in step_jobs:
+                    pending.remove(job)
+                    results[job.name] = None
+                # repeat the lines of the last build in place of the step's last job
+                report_lines[step_jobs[-1].name] = manifest.report_lines(step)
+
+    def finish(job, outcome):
+        results[job.name], report_lines[job.name], timings[job.name], job_stages = outcome
+        stages[job.name] = [dict(job=job.name, **record) for record in job_stages]
+        print(f"Finished {job.name} in {timings[job.name]:.1f}s")
+        logger.info(f"Finished {job.name} in {timings[job.name]:.1f}s")
+        step_jobs = steps[job.step]
+        if manifest is not None and all(j.name in timings for j in step_jobs):
+            manifest.record(
+                job.step,
+                fingerprints[job.step],
+                step_params(step_jobs),
+                [line for j in step_jobs for line in report_lines[j.name]],
+            )
+
+    # layers written to a shared GeoPackage are written one at a time
+    write_lock = multiprocessing.Lock()
+    layer_writers.set_write_lock(write_lock)
+    pool = (
+        ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_worker,
+            initargs=(write_lock, maker.monthYear),
+        )
+        if workers > 1
+        else None
+    )
+    try:
+        while pending or running:
+            ready = [job for job in pending if all(dep in results for dep in job.deps)]
+            if not ready and not running:
+                raise ValueError(f"Jobs with circular dependencies: {pending}")
+            for job in ready:
+                pending.remove(job)
+                dep_results = [results[dep] for dep in job.deps] if job.deps else None
+                if pool is None or job.in_parent:
+                    finish(
+                        job,
+                        run_job(
+                            job.func, path, folder, job.kwargs, dep_results, profile, trace_memory
+                        ),
+                    )
+                else:
+                    future = pool.submit(
+                        run_job,
+                        job.func,
+                        path,
+                        folder,
+                        job.kwargs,
+                        dep_results,
+                        profile,
+                        trace_memory,
+                    )
+                    running[future] = job
+            if running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(running.pop(future), future.result())
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        layer_writers.set_write_lock(None)
+        # write the report lines of the jobs that completed, in job order
+        maker.append_feature_report(
+            path, folder, [line for name in names for line in report_lines.get(name, [])]
+        )
+        if manifest is not None:
+            manifest.save()
+        if profile:
+            write_stage_report(
+                path, folder, [record for name in names for record in stages.get(name, [])]
+            )
+
+    return {name: timings[name] for name in names if name in timings}
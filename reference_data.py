@@ -0,0 +1,151 @@
+"""
+Reference tables the layers are built with that aren't part of the GTFS feeds:
+MTA's Stations.csv (the trains stopping at each subway station) and
+StationEntrances.csv.
+
+Tables are read lazily, the first time a builder needs them, and kept for the
+rest of the process. Downloads are saved in a `.reference_cache` folder in the
+data directory, next to a json file with their ETag/Last-Modified headers:
+- a cached copy younger than `max_age` is used as is
+- an older copy is revalidated with a conditional request, and only
+  downloaded again when it changed on the MTA site
+- when the site can't be reached, the cached copy is used whatever its age
+
+A table can also be pinned to a snapshot file with pin_snapshot, e.g. the
+StationEntrances.csv archived in a month folder, so that a month is rebuilt
+offline with the data it was first built with.
+"""
+
+import os
+import json
+import datetime
+import logging
+
+import pandas as pd
+
+# configure logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# reference table -> url it is downloaded from
+reference_urls = {
+    "Stations.csv": "http://web.mta.info/developers/data/nyct/subway/Stations.csv",
+    "StationEntrances.csv": "http://web.mta.info/developers/data/nyct/subway/StationEntrances.csv",
+}
+
+# name of the folder, created in the data directory, holding the downloaded tables
+cache_folder = ".reference_cache"
+
+# cached tables older than this are revalidated against the MTA site
+max_age = datetime.timedelta(days=7)
+
+# reference table -> pinned snapshot file, see pin_snapshot
+_snapshots = {}
+
+# tables read in this process, by (data directory, table name)
+_tables = {}
+
+
+def pin_snapshot(name, file_path):
+    """Read a reference table from a local file instead of the MTA site
+
+    Snapshots written with an index column (like the StationEntrances.csv
+    archived in the month folders) can be pinned as is. Pass None to unpin.
+
+    Params:
+        name (str): reference table, one of `reference_urls`
+        file_path (str): path of the snapshot file
+    """
+    if name not in reference_urls:
+        raise ValueError(f"Unknown reference table {name!r}, expected one of {list(reference_urls)}")
+    if file_path is None:
+        _snapshots.pop(name, None)
+    elif not os.path.exists(file_path):
+        raise FileNotFoundError(f"No snapshot of {name} at {file_path}")
+    else:
+        _snapshots[name] = os.path.abspath(file_path)
+    for key in [key for key in _tables if key[1] == name]:
+        del _tables[key]
+
+
+def cached_reference(path, name, refresh=False, session=None):
+    """Return the path of an up to date local copy of a reference table
+
+    Params:
+        path (str): data directory the `.reference_cache` folder is created in
+        name (str): reference table, one of `reference_urls`
+        refresh (bool): Default value False; revalidate the cached copy whatever its age
+        session (requests.Session, optional): session used for the request
+    Returns:
+        file_path (str): the pinned snapshot, or the cached download
+    """
+    if name in _snapshots:
+        return _snapshots[name]
+
+    cache_dir = os.path.join(path, cache_folder)
+    file_path = os.path.join(cache_dir, name)
+    meta_path = file_path + ".json"
+    cached = os.path.exists(file_path)
+    if cached and not refresh:
+        age = datetime.datetime.now() - datetime.datetime.fromtimestamp(
+            os.path.getmtime(file_path)
+        )
+        if age < max_age:
+            return file_path
+
+    meta = {}
+    if cached and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+    # imported here, the download modules are only needed when the cache is stale
+    import requests
+    from mta_gtfs_data_getter import fetch_feed, make_session
+
+    os.makedirs(cache_dir, exist_ok=True)
+    try:
+        changed, etag, last_modified = fetch_feed(
+            session or make_session(pool_size=1),
+            reference_urls[name],
+            file_path,
+            etag=meta.get("etag"),
+            last_modified=meta.get("last_modified"),
+        )
+    except (requests.RequestException, OSError):
+        if not cached:
+            raise
+        logger.warning(f"Couldn't revalidate {name}, using the copy cached in {cache_dir}")
+        return file_path
+
+    if changed:
+        logger.info(f"Downloaded {name} into {cache_dir}")
+    else:
+        # unchanged on the server, fresh for another max_age
+        os.utime(file_path)
+    with open(meta_path, "w") as f:
+        json.dump(
+            {"url": reference_urls[name], "etag": etag, "last_modified": last_modified},
+            f,
+            indent=2,
+        )
+    return file_path
+
+
+def read_reference(path, name, refresh=False):
+    """Return a reference table, read once per process (see cached_reference)
+
+    The table is shared between callers and should be treated as read-only.
+
+    Params:
+        path (str): data directory the `.reference_cache` folder is created in
+        name (str): reference table, one of `reference_urls`
+        refresh (bool): Default value False; revalidate the cached copy whatever its age
+    """
+    key = (os.path.abspath(path), name)
+    if refresh or key not in _tables:
+        df = pd.read_csv(cached_reference(path, name, refresh=refresh))
+        # archived copies were written with their index
+        if len(df.columns) and df.columns[0].startswith("Unnamed: 0"):
+            df = df.drop(columns=df.columns[0])
+        _tables[key] = df
+    return _tables[key]
@@ -0,0 +1,146 @@
+"""
+Catalog of the routes of a feed, built once per service and shared by the
+stops and routes builders.
+
+Each distinct route_id of routes.txt and trips.txt gets one row with its
+names (route_short, route_long), its color as written to the layers (a hex
+color with a leading "#"), its subway group and whether it is a local bus
+route; routes only found in trips.txt are flagged as not listed. The subway fixes are applied there once: the colors missing for the
+shuttles and the Staten Island Railway and the JZ short name of the J.
+
+The row number of a route is its integer code. Builders turn their route_id
+column into codes (RouteCatalog.codes factorizes it, or reuses the codes of a
+categorical column) and take the attributes of every row with array indexing,
+so the local/express pattern is matched once per route rather than once per
+stop or line, and stops and routes are classified the same way.
+"""
+
+import numpy as np
+import pandas as pd
+
+# route_ids matching this pattern are local bus routes, the others are express
+local_route_pattern = r"([A-W-Z]\d+|BX\d+)(?!^X\.*?)"
+
+# subway route -> group, used for MTA's subway map-like coloring of the routes
+subway_groups = {
+    "FS": "S",
+    "GS": "S",
+    "1": "123",
+    "3": "123",
+    "2": "123",
+    "5": "456",
+    "4": "456",
+    "7": "7",
+    "6": "456",
+    "A": "ACE",
+    "C": "ACE",
+    "E": "ACE",
+    "B": "BDFM",
+    "D": "BDFM",
+    "G": "G",
+    "F": "BDFM",
+    "H": "S",
+    "J": "JZ",
+    "M": "BDFM",
+    "L": "L",
+    "N": "NQRW",
+    "Q": "NQRW",
+    "R": "NQRW",
+    "SI": "SIR",
+    "W": "NQRW",
+}
+
+# colors missing from the subway feed, for the S and SIR lines
+subway_colors = {"FS": "808183", "H": "808183", "SI": "053159"}
+
+# subway short names shown differently on the map
+subway_short_names = {"J": "JZ"}
+
+catalog_columns = ["route_short", "route_long", "color", "group", "local"]
+
+
+class RouteCatalog:
+    """Attributes of each distinct route of a service
+
+    Params:
+        routes (DataFrame): routes.txt
+        trips (DataFrame, optional): trips.txt, its routes missing from routes.txt
+            are cataloged without names or color
+        service (str, optional): name of the service folder; the subway fixes are
+            applied for "nyc_subway"
+    """
+
+    def __init__(self, routes, trips=None, service=None):
+        route_ids = [routes["route_id"]]
+        if trips is not None:
+            route_ids.append(trips["route_id"])
+        self.index = pd.Index(
+            pd.concat([pd.Series(ids.unique()) for ids in route_ids]).dropna().unique(),
+            name="route_id",
+        )
+
+        routes = pd.DataFrame(
+            routes,
+            columns=["route_id", "route_short_name", "route_long_name", "route_color"],
+        )
+        # routes of trips.txt missing from routes.txt aren't written to the layers
+        self.listed = self.index.isin(routes["route_id"])
+        routes = routes.drop_duplicates("route_id").set_index("route_id").reindex(self.index)
+        df = pd.DataFrame(
+            {
+                "route_short": routes["route_short_name"],
+                "route_long": routes["route_long_name"],
+                "color": routes["route_color"],
+            },
+            index=self.index,
+        )
+        df["group"] = self.index.map(subway_groups) if service == "nyc_subway" else None
+        if service == "nyc_subway":
+            fixes = self.index.isin(list(subway_colors))
+            df.loc[fixes, "color"] = self.index[fixes].map(subway_colors)
+            fixes = self.index.isin(list(subway_short_names))
+            df.loc[fixes, "route_short"] = self.index[fixes].map(subway_short_names)
+        df["color"] = ("#" + df["color"].astype(str)).where(df["color"].notna())
+        df["local"] = self.index.str.match(local_route_pattern, na=False)
+        self.routes = df[catalog_columns]
+
+    def __len__(self):
+        return len(self.index)
+
+    def codes(self, route_ids):
+        """Return the integer code of each route_id, -1 for routes not in the catalog
+
+        The distinct values are looked up once: through the categories of a
+        categorical column, otherwise after factorizing the column.
+        """
+        if isinstance(getattr(route_ids, "dtype", None), pd.CategoricalDtype):
+            codes = np.asarray(route_ids.cat.codes)
+            uniques = route_ids.cat.categories
+        else:
+            codes, uniques = pd.factorize(route_ids)
+        lookup = np.append(self.index.get_indexer(uniques), -1)
+        # missing values have code -1, which takes the appended -1
+        return lookup[codes]
+
+    def attributes(self, route_ids, columns=catalog_columns):
+        """Return the catalog columns for each route_id, aligned with `route_ids`
+
+        Routes not in the catalog get missing values (and local False).
+        """
+        codes = self.codes(route_ids)
+        df = self.routes[list(columns)].reset_index(drop=True)
+        df = df.reindex(np.where(codes < 0, len(df), codes))
+        if "local" in df:
+            df["local"] = df["local"].fillna(False).astype(bool)
+        df.index = route_ids.index if isinstance(route_ids, pd.Series) else range(len(df))
+        return df
+
+    def is_local(self, route_ids):
+        """Return a boolean array, True where the route is a local bus route"""
+        codes = self.codes(route_ids)
+        return np.append(self.routes["local"].to_numpy(dtype=bool), False)[codes]
+
+    def is_listed(self, route_ids):
+        """Return a boolean array, True where the route is listed in routes.txt"""
+        codes = self.codes(route_ids)
+        return np.append(self.listed, False)[codes]
@@ -0,0 +1,209 @@
+"""
+Service frequency of each stop, computed from stop_times.txt.
+
+The frequency of a stop is the average number of trips stopping at it per
+weekday, Saturday and Sunday, in total and within hour bands (see `hour_bands`).
+It counts the trips of every route serving the stop. stop_times.txt is read in
+chunks in a single pass: stop and trip IDs are turned into integer codes and
+the stop visits of each chunk are counted with np.bincount into a
+stop x service x hour band array, so memory is bounded by the number of stops
+and services rather than the size of the table. The services are then
+weighted by the share of weekdays, Saturdays and Sundays they run on, from
+calendar.txt and calendar_dates.txt.
+"""
+
+import numpy as np
+import pandas as pd
+
+# hour band -> (first hour, last hour excluded); times past 24:00 wrap around
+hour_bands = {
+    "ngt": (0, 6),
+    "am": (6, 10),
+    "mid": (10, 15),
+    "pm": (15, 19),
+    "eve": (19, 24),
+}
+
+# day type -> days of the week (Monday is 0)
+day_types = {"wkd": [0, 1, 2, 3, 4], "sat": [5], "sun": [6]}
+
+calendar_days = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+# band of each hour of the day
+_hour_band = np.zeros(24, dtype=np.int64)
+for _band, (_start, _end) in enumerate(hour_bands.values()):
+    _hour_band[_start:_end] = _band
+
+
+def frequency_columns():
+    """Return the names of the frequency columns, e.g. "wkd_trips" and "wkd_am"
+
+    Names are at most 10 characters, so they are kept in shapefiles.
+    """
+    return [
+        f"{day}_{band}" for day in day_types for band in ["trips"] + list(hour_bands)
+    ]
+
+
+def service_day_weights(calendar, calendar_dates):
+    """Return the share of weekdays, Saturdays and Sundays each service runs on
+
+    Services are expanded to the dates they run on over the period covered by
+    the calendar, with the calendar_dates exceptions applied.
+
+    Params:
+        calendar, calendar_dates (DataFrame): calendar.txt and calendar_dates.txt,
+            either can be None
+    Returns:
+        weights (DataFrame): indexed by service_id, one column per day type
+    """
+    frames = [df for df in (calendar, calendar_dates) if df is not None and len(df)]
+    if not frames:
+        return pd.DataFrame(columns=list(day_types), dtype=float)
+    service_ids = pd.Index(
+        pd.concat([df["service_id"].astype(str) for df in frames]).unique()
+    )
+
+    def parse(dates):
+        return pd.to_datetime(dates.astype(str), format="%Y%m%d")
+
+    bounds = []
+    if calendar is not None and len(calendar):
+        bounds += [parse(calendar["start_date"]), parse(calendar["end_date"])]
+    if calendar_dates is not None and len(calendar_dates):
+        bounds.append(parse(calendar_dates["date"]))
+    bounds = pd.concat(bounds)
+    dates = pd.date_range(bounds.min(), bounds.max())
+
+    # services x dates
+    runs = np.zeros((len(service_ids), len(dates)), dtype=bool)
+    if calendar is not None and len(calendar):
+        rows = service_ids.get_indexer(calendar["service_id"].astype(str))
+        start = parse(calendar["start_date"]).to_numpy()[:, None]
+        end = parse(calendar["end_date"]).to_numpy()[:, None]
+        days = calendar[calendar_days].to_numpy(dtype=bool)[:, dates.dayofweek]
+        in_range = (dates.to_numpy()[None, :] >= start) & (dates.to_numpy()[None, :] <= end)
+        np.logical_or.at(runs, rows, days & in_range)
+    if calendar_dates is not None and len(calendar_dates):
+        rows = service_ids.get_indexer(calendar_dates["service_id"].astype(str))
+        columns = dates.get_indexer(parse(calendar_dates["date"]))
+        exception = calendar_dates["exception_type"].to_numpy()
+        runs[rows[exception == 1], columns[exception == 1]] = True
+        runs[rows[exception == 2], columns[exception == 2]] = False
+
+    weights = {}
+    for day, weekdays in day_types.items():
+        of_type = np.isin(dates.dayofweek, weekdays)
+        weights[day] = runs[:, of_type].mean(axis=1) if of_type.any() else 0.0
+    return pd.DataFrame(weights, index=service_ids)
+
+
+class StopFrequencies:
+    """Counts the trips stopping at each stop over chunks of stop_times.txt
+
+    Child stops (platforms) are counted under their parent_station when stops.txt
+    has one, so subway stations get the trips of both directions.
+
+    Params:
+        stops (DataFrame): stops.txt
+        trips (DataFrame): trips.txt
+        calendar, calendar_dates (DataFrame): calendar.txt and calendar_dates.txt,
+            either can be None
+    """
+
+    def __init__(self, stops, trips, calendar, calendar_dates):
+        stop_ids = stops["stop_id"]
+        keys = stop_ids
+        if "parent_station" in stops:
+            parents = stops["parent_station"]
+            keys = parents.where(parents.notna() & (parents.astype(str) != ""), stop_ids)
+        # integer code of the stop (or parent station) each stop_id is counted under
+        self.stop_ids = pd.Index(keys.unique())
+        self._stop_codes = pd.Series(
+            self.stop_ids.get_indexer(keys), index=stop_ids.astype(str).to_numpy()
+        )
+        self._stop_codes = self._stop_codes[~self._stop_codes.index.duplicated()]
+
+        self.weights = service_day_weights(calendar, calendar_dates)
+        services = trips["service_id"].astype(str)
+        self.weights = self.weights.reindex(pd.Index(services.unique())).fillna(0.0)
+        trips = trips.drop_duplicates("trip_id")
+        self._trip_index = pd.Index(trips["trip_id"].astype(str))
+        self._trip_services = self.weights.index.get_indexer(
+            trips["service_id"].astype(str)
+        )
+
+        self._shape = (len(self.stop_ids), len(self.weights), len(hour_bands))
+        self._counts = np.zeros(int(np.prod(self._shape)), dtype=np.int64)
+
+    def add(self, stop_times):
+        """Count the stop visits of a chunk of stop_times.txt
+
+        Visits without a departure or arrival time (untimed stops) aren't counted.
+        """
+        times = stop_times["departure_time"]
+        if "arrival_time" in stop_times:
+            times = times.fillna(stop_times["arrival_time"])
+        hours = pd.to_numeric(times.astype(str).str.strip().str[:-6], errors="coerce")
+        stops = self._stop_codes.reindex(stop_times["stop_id"].astype(str).to_numpy()).to_numpy()
+        trips = self._trip_index.get_indexer(stop_times["trip_id"].astype(str))
+        valid = hours.notna().to_numpy() & ~np.isnan(stops) & (trips >= 0)
+        services = self._trip_services[trips[valid]]
+        bands = _hour_band[hours.to_numpy()[valid].astype(np.int64) % 24]
+        keys = (stops[valid].astype(np.int64) * self._shape[1] + services) * self._shape[2] + bands
+        self._counts += np.bincount(keys, minlength=len(self._counts))
+
+    def result(self):
+        """Return the average trips per day type and hour band of each stop
+
+        Returns:
+            df: (DataFrame) with stop_id and `frequency_columns` columns
+        """
+        counts = self._counts.reshape(self._shape)
+        # stops x day types x bands
+        per_day = np.einsum("sib,id->sdb", counts, self.weights.to_numpy())
+        columns = {"stop_id": self.stop_ids}
+        for d, day in enumerate(day_types):
+            columns[f"{day}_trips"] = per_day[:, d, :].sum(axis=1).round(1)
+            for b, band in enumerate(hour_bands):
+                columns[f"{day}_{band}"] = per_day[:, d, b].round(1)
+        return pd.DataFrame(columns)
+
+
+def optional_table(store, service, name):
+    """Return a table of a service, or None when the service doesn't have it"""
+    if not store.has_table(service, name):
+        return None
+    return store.table(service, name)
+
+
+def frequency_counter(store, service):
+    """Return a StopFrequencies over the tables of a service of a FeedStore"""
+    return StopFrequencies(
+        store.table(service, "stops.txt"),
+        store.table(service, "trips.txt"),
+        optional_table(store, service, "calendar.txt"),
+        optional_table(store, service, "calendar_dates.txt"),
+    )
+
+
+def stop_frequencies(store, service, chunksize=500000):
+    """Return the service frequency of each stop of a service
+
+    Params:
+        store (FeedStore): store the tables are read from
+        service (str): name of the service folder, e.g. "bx_bus" or "nyc_subway"
+        chunksize (int): number of stop_times.txt rows read at a time
+    Returns:
+        df: (DataFrame) with stop_id and `frequency_columns` columns
+    """
+    counter = frequency_counter(store, service)
+    for chunk in store.iter_table(
+        service,
+        "stop_times.txt",
+        chunksize,
+        usecols=["trip_id", "stop_id", "arrival_time", "departure_time"],
+        dtype={"stop_id": str},
+    ):
+        counter.add(chunk)
+    return counter.result()
@@ -0,0 +1,195 @@
+"""
+Per-stage profiling of the shapefile builders.
+
+The builders wrap their stages (table reads, merges, geometry building,
+dissolve, reprojection, county join and layer writing) in `profile_stage`
+blocks, or decorate them with `profiled`. Inside a `recording` block each stage appends a record with its wall
+time, the input and output row counts, the peak memory traced while it ran
+(with trace_memory on) and the peak RSS of the process when it finished.
+Outside of one, `profile_stage` returns a shared no-op object and `profiled`
+calls the function directly, so the instrumentation costs a function call per
+stage and nothing is measured.
+
+Records are written with write_stage_report to stage_report.json and
+stage_report.csv next to feature_report.txt.
+"""
+
+import os
+import json
+import time
+import tracemalloc
+from functools import wraps
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    # peak RSS of the process, not available on Windows
+    import resource
+except ImportError:
+    resource = None
+
+# records of the innermost active recording block, None when profiling is off
+_records = None
+# stages currently running, outermost first
+_active = []
+
+
+def count_rows(frames):
+    """Return the total number of rows of a DataFrame or a list of DataFrames"""
+    if frames is None:
+        return None
+    if isinstance(frames, (list, tuple)):
+        return sum(len(frame) for frame in frames)
+    return len(frames)
+
+
+def max_rss_mb():
+    """Return the peak resident set size of the process in MB"""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class _NullStage:
+    """Stage used when profiling is off"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def output(self, frames):
+        return frames
+
+
+_null_stage = _NullStage()
+
+
+class _Stage:
+    def __init__(self, name, rows_in, labels):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.labels = labels
+        self.peak = 0
+
+    def __enter__(self):
+        self.tracing = tracemalloc.is_tracing()
+        if self.tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            # keep the peak reached so far by the enclosing stage before resetting it
+            if _active:
+                _active[-1].peak = max(_active[-1].peak, peak)
+            self.start_memory = current
+            tracemalloc.reset_peak()
+        _active.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def output(self, frames):
+        """Record the row count of the stage's output and return it unchanged"""
+        self.rows_out = count_rows(frames)
+        return frames
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        _active.remove(self)
+        record = dict(self.labels)
+        record.update(
+            stage=self.name,
+            seconds=round(elapsed, 6),
+            rows_in=self.rows_in,
+            rows_out=self.rows_out,
+            traced_peak_mb=None,
+            max_rss_mb=max_rss_mb(),
+            failed=exc_type is not None,
+        )
+        if self.tracing and tracemalloc.is_tracing():
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            record["traced_peak_mb"] = round((self.peak - self.start_memory) / 2**20, 3)
+            if _active:
+                _active[-1].peak = max(_active[-1].peak, self.peak)
+        if _records is not None:
+            _records.append(record)
+        return False
+
+
+def profile_stage(name, frames=None, **labels):
+    """Profile the stage run in the block
+
+    Params:
+        name (str): name of the stage, e.g. "merge" or "dissolve"
+        frames (DataFrame or list, optional): input of the stage, for its row count
+        labels: extra fields of the record, e.g. service="bx_bus"
+    Returns:
+        stage: context manager; call `stage.output(frames)` in the block to record
+        the output row count
+    """
+    if _records is None:
+        return _null_stage
+    return _Stage(name, count_rows(frames), labels)
+
+
+def profiled(name):
+    """Decorator profiling every call of a function as a stage named `name`
+
+    The input row count is taken from the first positional argument and the
+    output row count from the return value.
+    """
+
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _records is None:
+                return func(*args, **kwargs)
+            rows_in = count_rows(args[0]) if args else None
+            with _Stage(name, rows_in, {"function": func.__name__}) as stage:
+                return stage.output(func(*args, **kwargs))
+
+        return wrapper
+
+    return decorate
+
+
+@contextmanager
+def recording(enabled=True, trace_memory=False):
+    """Record the stages profiled inside the block
+
+    Params:
+        enabled (bool): Default value True; with False the block profiles nothing
+        trace_memory (bool): Default value False; trace Python memory allocations
+            with tracemalloc to get the peak memory of each stage (slows stages down)
+    Yields the list the stage records are collected into.
+    """
+    global _records
+    records = []
+    if not enabled:
+        yield records
+        return
+    outer = _records
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    _records = records
+    try:
+        yield records
+    finally:
+        _records = outer
+        if started_tracing:
+            tracemalloc.stop()
+
+
+def write_stage_report(path, folder, records):
+    """Write stage records to stage_report.json and stage_report.csv
+
+    Params:
+        path(str): Path to the directory where GTFS data is stored
+        folder (str): Name of the folder where the GTFS data is stored
+        records (list): stage records collected by `recording` blocks
+    """
+    with open(os.path.join(path, folder, "stage_report.json"), "w") as f:
+        json.dump(records, f, indent=2)
+    pd.DataFrame(records).to_csv(os.path.join(path, folder, "stage_report.csv"), index=False)
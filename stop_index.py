@@ -0,0 +1,280 @@
+"""
+Nearest-stop and stops-within-radius queries over the built stop layers.
+
+StopIndex holds the points of the stop and subway entrance layers of a month
+folder in NY State Plane (EPSG:2263, feet) and answers batched queries for
+arrays of x, y coordinates: the k nearest stops of each point and every stop
+within a radius of each point. The points are indexed with a scipy KD-tree
+when scipy is installed, otherwise with a shapely STRtree. An index can be
+saved to a file and loaded back, so repeated queries skip reading the layers
+and building the tree.
+
+usage: python stop_index.py <folder> [--path DIR] [--output FILE]
+"""
+
+import os
+import pickle
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import Transformer
+
+from layer_changes import find_layer, read_layer
+
+try:
+    # KD-tree used for the queries when available, an STRtree is used otherwise
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+# configure logger
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# point layers indexed by default (names without the month suffix)
+point_layers = [
+    "bus_stops_nyc",
+    "express_bus_stops_nyc",
+    "stops_LIRR",
+    "stops_metro_north",
+    "stops_nyc_subway",
+    "metro_north_bx_bus",
+    "subway_entrances",
+]
+
+# layers whose stop name isn't in a stop_name column
+name_columns = {"subway_entrances": "stn_name"}
+
+index_epsg = 2263
+
+
+def project(x, y, from_epsg=4326):
+    """Return coordinates transformed to the index coordinate system (NY State Plane, ft)
+
+    Params:
+        x, y (array): coordinates, longitude and latitude for geographic systems
+        from_epsg (int): Default value 4326; EPSG value of the x, y coordinate system
+    Returns:
+        x, y (tuple): arrays of State Plane coordinates
+    """
+    transformer = Transformer.from_crs(from_epsg, index_epsg, always_xy=True)
+    return transformer.transform(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+
+
+class StopIndex:
+    """Spatial index over stop points, in NY State Plane feet
+
+    Params:
+        xy (array): (n, 2) array of point coordinates
+        stops (DataFrame): one row per point, e.g. layer, stop_id and stop_name,
+            returned by `records`
+        use_kdtree (bool, optional): index with scipy's cKDTree, defaults to
+            True when scipy is installed
+    """
+
+    def __init__(self, xy, stops, use_kdtree=None):
+        self.xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+        self.stops = stops.reset_index(drop=True)
+        if use_kdtree is None:
+            use_kdtree = cKDTree is not None
+        if use_kdtree and cKDTree is None:
+            raise ImportError("scipy is needed to use a KD-tree")
+        if use_kdtree:
+            self._tree = cKDTree(self.xy)
+        else:
+            self._tree = shapely.STRtree(shapely.points(self.xy))
+        # distance from each stop to its k-th nearest stop, by k (STRtree only)
+        self._spacing = {}
+
+    @property
+    def uses_kdtree(self):
+        return cKDTree is not None and isinstance(self._tree, cKDTree)
+
+    def __len__(self):
+        return len(self.xy)
+
+    @classmethod
+    def from_layers(cls, path, folder, layers=None, use_kdtree=None):
+        """Build an index over the point layers of a month folder
+
+        Params:
+            path(str): Path to the directory where the month folders are stored
+            folder (str): Name of the month folder
+            layers (list, optional): layers to index, defaults to `point_layers`
+            use_kdtree (bool, optional): see StopIndex
+        """
+        shapes_dir = os.path.join(path, folder, "shapes")
+        xy = []
+        stops = []
+        for layer in layers or point_layers:
+            location = find_layer(shapes_dir, layer)
+            if location is None:
+                logger.info(f"Skipped {layer}, it isn't in {folder}")
+                continue
+            gdf = read_layer(location)
+            if gdf.crs is not None and gdf.crs.to_epsg() != index_epsg:
+                gdf = gdf.to_crs(epsg=index_epsg)
+            xy.append(shapely.get_coordinates(gdf.geometry.values))
+            name = name_columns.get(layer, "stop_name")
+            stops.append(
+                pd.DataFrame(
+                    {
+                        "layer": layer,
+                        "stop_id": gdf["stop_id"].astype(str) if "stop_id" in gdf else None,
+                        "stop_name": gdf[name] if name in gdf else None,
+                    },
+                    index=gdf.index,
+                )
+            )
+        if not xy:
+            raise FileNotFoundError(f"No point layers in {shapes_dir}")
+        return cls(
+            np.concatenate(xy), pd.concat(stops, ignore_index=True), use_kdtree=use_kdtree
+        )
+
+    def nearest(self, x, y, k=1, max_distance=np.inf):
+        """Return the k nearest stops of each query point
+
+        Params:
+            x, y (array): coordinates of the query points, in State Plane feet
+            k (int): Default value 1; number of stops returned per point
+            max_distance (float): Default value inf; stops farther away aren't returned
+        Returns:
+            distances, indices (tuple): (n, k) arrays sorted by distance, with
+            inf and -1 where fewer than k stops were found
+        """
+        xy = np.column_stack([np.ravel(x), np.ravel(y)]).astype(float)
+        k = min(k, len(self))
+        if self.uses_kdtree:
+            distances, indices = self._tree.query(
+                xy, k=k, distance_upper_bound=max_distance
+            )
+            distances = distances.reshape(len(xy), k)
+            indices = indices.reshape(len(xy), k)
+            indices[np.isinf(distances)] = -1
+            return distances, indices
+        return self._strtree_nearest(xy, k, max_distance)
+
+    def _strtree_nearest(self, xy, k, max_distance):
+        """k nearest stops through the STRtree, which only returns the single nearest
+
+        By the triangle inequality the k nearest stops of a point are within the
+        distance to its nearest stop plus the distance from that stop to its own
+        k-th nearest stop, so one radius query per point finds them.
+        """
+        points = shapely.points(xy)
+        (query, first_stop), first = self._tree.query_nearest(
+            points,
+            max_distance=None if np.isinf(max_distance) else max_distance,
+            return_distance=True,
+            all_matches=False,
+        )
+        # keep a single nearest stop when several are at the same distance
+        query, unique = np.unique(query, return_index=True)
+        if k == 1:
+            distances = np.full((len(xy), 1), np.inf)
+            indices = np.full((len(xy), 1), -1)
+            distances[query, 0] = first[unique]
+            indices[query, 0] = first_stop[unique]
+            return distances, indices
+        radius = np.minimum(first[unique] + self._kth_spacing(k)[first_stop[unique]], max_distance)
+        return self._ranked(xy, query, radius, k, max_distance)
+
+    def _kth_spacing(self, k):
+        """Return, for each stop, the distance to its k-th nearest stop (itself included)
+
+        Computed once per k by querying the stops with a radius doubled until
+        they have k stops within it.
+        """
+        if k not in self._spacing:
+            spacing = np.zeros(len(self))
+            pending = np.arange(len(self))
+            radius = np.ones(len(self))
+            while len(pending) and k > 1:
+                distances, _ = self._ranked(self.xy, pending, radius[pending], k, np.inf)
+                done = np.isfinite(distances[pending, -1])
+                spacing[pending[done]] = distances[pending[done], -1]
+                pending = pending[~done]
+                radius[pending] *= 2
+            self._spacing[k] = spacing
+        return self._spacing[k]
+
+    def _ranked(self, xy, query, radius, k, max_distance):
+        """Return the k nearest stops found within `radius` of the points `query` of `xy`"""
+        distances = np.full((len(xy), k), np.inf)
+        indices = np.full((len(xy), k), -1)
+        if len(query) == 0:
+            return distances, indices
+        found, stops = self._tree.query(
+            shapely.points(xy[query]), predicate="dwithin", distance=radius
+        )
+        found = query[found]
+        d = np.hypot(*(self.xy[stops] - xy[found]).T)
+        keep = d <= max_distance
+        found, stops, d = found[keep], stops[keep], d[keep]
+        order = np.lexsort((d, found))
+        found, stops, d = found[order], stops[order], d[order]
+        rank = np.arange(len(found)) - np.searchsorted(found, found)
+        take = rank < k
+        distances[found[take], rank[take]] = d[take]
+        indices[found[take], rank[take]] = stops[take]
+        return distances, indices
+
+    def within(self, x, y, radius):
+        """Return every stop within `radius` of each query point
+
+        Params:
+            x, y (array): coordinates of the query points, in State Plane feet
+            radius (float): search radius in feet
+        Returns:
+            query, stops, distances (tuple): flat arrays of the query point index,
+            the stop index and their distance, sorted by query point and distance
+        """
+        xy = np.column_stack([np.ravel(x), np.ravel(y)]).astype(float)
+        if self.uses_kdtree:
+            pairs = cKDTree(xy).sparse_distance_matrix(
+                self._tree, radius, output_type="ndarray"
+            )
+            query, stops, distances = pairs["i"], pairs["j"], pairs["v"]
+        else:
+            query, stops = self._tree.query(
+                shapely.points(xy), predicate="dwithin", distance=radius
+            )
+            distances = np.hypot(*(self.xy[stops] - xy[query]).T)
+        order = np.lexsort((distances, query))
+        return query[order], stops[order], distances[order]
+
+    def records(self, indices):
+        """Return the stop rows of an array of indices returned by a query (-1 gives empty rows)"""
+        indices = np.ravel(indices)
+        rows = self.stops.reindex(np.where(indices < 0, len(self.stops), indices))
+        return rows.reset_index(drop=True)
+
+    def save(self, file_path):
+        """Save the index, tree included, to a pickle file"""
+        with open(file_path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(file_path):
+        """Load an index saved with save"""
+        with open(file_path, "rb") as f:
+            return pickle.load(f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build the stop index of a month folder and save it"
+    )
+    parser.add_argument("folder")
+    parser.add_argument("--path", default=os.getcwd(), help="directory of the month folders")
+    parser.add_argument("--output", help="index file, defaults to <folder>/shapes/stop_index.pkl")
+    args = parser.parse_args()
+
+    index = StopIndex.from_layers(args.path, args.folder)
+    output = args.output or os.path.join(args.path, args.folder, "shapes", "stop_index.pkl")
+    index.save(output)
+    print(f"Indexed {len(index)} stops into {output}")